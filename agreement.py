@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Agreement between the risk scores of two runs on the same input list, e.g.
+# two preprocessing profiles or two inference precisions.
+#   python agreement.py --reference results_accurate/cvd_results.csv \
+#       --candidate results_fast/cvd_results.csv --report agreement.csv
+
+import argparse
+import csv
+import json
+
+import numpy as np
+from scipy.stats import pearsonr, spearmanr
+
+
+def read_results(csv_path):
+    # Last row per input path, as written by cvdrisk_BIDS.py
+    with open(csv_path, newline='') as csvfile:
+        return {row['input_path']: row for row in csv.DictReader(csvfile)}
+
+
+def compare_results(reference_csv, candidate_csv):
+    """Summary statistics and per-scan rows comparing candidate to reference."""
+    reference = read_results(reference_csv)
+    candidate = read_results(candidate_csv)
+    rows = []
+    for input_path, ref in reference.items():
+        cand = candidate.get(input_path)
+        if cand is None:
+            continue
+        row = {
+            'input_path': input_path,
+            'reference_status': ref['status'],
+            'candidate_status': cand['status'],
+            'reference_score': None,
+            'candidate_score': None,
+            'abs_diff': None,
+            'slices_match': None,
+        }
+        if ref['status'] == 'success' and cand['status'] == 'success':
+            row['reference_score'] = float(ref['cvd_risk_score'])
+            row['candidate_score'] = float(cand['cvd_risk_score'])
+            row['abs_diff'] = abs(row['candidate_score'] - row['reference_score'])
+            row['slices_match'] = (ref['first_heart_slice'] == cand['first_heart_slice']
+                                   and ref['last_heart_slice'] == cand['last_heart_slice'])
+        rows.append(row)
+
+    scored = [row for row in rows if row['abs_diff'] is not None]
+    summary = {
+        'compared': len(rows),
+        'scored_by_both': len(scored),
+        'status_disagreements': sum(row['reference_status'] != row['candidate_status'] for row in rows),
+        'heart_slice_disagreements': sum(not row['slices_match'] for row in scored),
+    }
+    if scored:
+        diff = np.array([row['abs_diff'] for row in scored])
+        summary.update({
+            'abs_diff_mean': float(diff.mean()),
+            'abs_diff_median': float(np.median(diff)),
+            'abs_diff_p95': float(np.percentile(diff, 95)),
+            'abs_diff_max': float(diff.max()),
+        })
+    if len(scored) > 1:
+        ref_scores = [row['reference_score'] for row in scored]
+        cand_scores = [row['candidate_score'] for row in scored]
+        summary['pearson_r'] = float(pearsonr(ref_scores, cand_scores)[0])
+        summary['spearman_rho'] = float(spearmanr(ref_scores, cand_scores)[0])
+    for name, results in (('reference', reference), ('candidate', candidate)):
+        times = [float(row['processing_time_seconds']) for row in results.values()
+                 if row['input_path'] in candidate and row['input_path'] in reference]
+        summary[f'{name}_seconds'] = float(np.sum(times))
+    if summary['candidate_seconds'] > 0:
+        summary['speedup'] = summary['reference_seconds'] / summary['candidate_seconds']
+    return summary, rows
+
+
+def write_report(rows, report_path):
+    with open(report_path, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()) if rows else ['input_path'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Risk score agreement between two runs')
+    parser.add_argument('--reference', required=True, type=str,
+                        help='reference: cvd_results.csv of the reference run')
+    parser.add_argument('--candidate', required=True, type=str,
+                        help='candidate: cvd_results.csv of the run to compare')
+    parser.add_argument('--report', default=None, type=str,
+                        help='report: CSV file for the per-scan comparison. Default: summary only')
+    opt = parser.parse_args()
+    summary, rows = compare_results(opt.reference, opt.candidate)
+    print(json.dumps(summary, indent=2))
+    if opt.report is not None:
+        write_report(rows, opt.report)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,121 @@
 
 
 import numpy as np
+import SimpleITK as sitk
 
-from utils import CT_resize
+from utils import CT_resize, image_min
 
 
-def calibrate_resizer(image, min_point, max_point, new_size):
+def calibrate_resizer(image, min_point, max_point, new_size, default_value=None,
+                      crop_first=False, interpolator=sitk.sitkGaussian):
     org_space = np.array(image.GetSpacing())
     org_size = max_point - min_point
     new_space = org_space * org_size / new_size
     new_org = min_point * org_space
+    if crop_first and interpolator == sitk.sitkGaussian:
+        return crop_resample(image, min_point, max_point, new_size, new_space, new_org, default_value)
     return CT_resize(
         image, new_size=new_size.tolist(),
         new_space=new_space.tolist(),
-        new_org=new_org.tolist())
+        new_org=new_org.tolist(),
+        default_value=default_value,
+        interpolator=interpolator)
+
+
+def gaussian_weights(cindex, size, sigma=0.8, alpha=4.0):
+    """sitkGaussian interpolation weights of continuous indices along one axis.
+
+    Follows itk::GaussianInterpolateImageFunction as SimpleITK sets it up:
+    sigma of 0.8 voxel, cut off at alpha sigma, and erf differences over the
+    voxel edges, renormalized inside the image.
+    """
+    # scipy is only loaded by --crop-first
+    from scipy.special import erf
+
+    scale = 1.0 / (np.sqrt(2.0) * sigma)
+    cutoff = sigma * alpha
+    begin = np.maximum(np.floor(cindex + 0.5 - cutoff).astype('int'), 0)
+    end = np.minimum(np.ceil(cindex + 0.5 + cutoff).astype('int'), size)
+    weights = np.zeros((len(cindex), size))
+    rows = np.arange(len(cindex))
+    # t is accumulated voxel by voxel as ITK does
+    t = (-0.5 - cindex + begin) * scale
+    last = erf(t)
+    for offset in range((end - begin).max()):
+        t = t + scale
+        now = erf(t)
+        valid = begin + offset < end
+        weights[rows[valid], begin[valid] + offset] = (now - last)[valid]
+        last = now
+    # indices with no voxel in reach are outside the image, see crop_resample
+    total = weights.sum(axis=1, keepdims=True)
+    return np.divide(weights, total, out=weights, where=total > 0)
+
+
+def resample_inside(image, axis, new_size, new_space, new_org):
+    """Which of the new_size points along axis ResampleImageFilter maps
+    inside image. The points beyond the outer voxel edges get its default
+    value, e.g. the last slices of an upsampled bbox ending at the image
+    border. Points right on an edge depend on its rounding, so a line of
+    ones along axis is resampled the same way to ask it.
+    """
+    size = [1, 1, 1]
+    size[axis] = image.GetSize()[axis]
+    line = sitk.Image(size, sitk.sitkUInt8) + 1
+    line.SetSpacing(image.GetSpacing())
+    line.SetOrigin(image.GetOrigin())
+    line.SetDirection(image.GetDirection())
+    out_size = [1, 1, 1]
+    out_size[axis] = int(new_size)
+    out_space = list(image.GetSpacing())
+    out_space[axis] = float(new_space)
+    out_org = list(image.GetOrigin())
+    out_org[axis] = float(new_org)
+    resampled = CT_resize(line, new_size=out_size, new_space=out_space, new_org=out_org,
+                          default_value=0, interpolator=sitk.sitkNearestNeighbor)
+    return sitk.GetArrayViewFromImage(resampled).reshape(-1) > 0
+
+
+def crop_resample(image, min_point, max_point, new_size, new_space, new_org, default_value=None):
+    # Gaussian resampling of the bbox region only. The Gaussian weights are
+    # separable, so the region is resampled one axis at a time instead of
+    # evaluating the full 3D kernel at every output voxel.
+    size = image.GetSize()
+    weights = []
+    inside = []
+    for d in range(3):
+        cindex = min_point[d] + np.arange(new_size[d]) * (max_point[d] - min_point[d]) / new_size[d]
+        weights.append(gaussian_weights(cindex, size[d]))
+        inside.append(resample_inside(image, d, new_size[d], new_space[d], new_org[d]))
+    # crop to the voxels that carry weight, padded by the kernel support
+    region = []
+    for d in range(3):
+        columns = np.nonzero(weights[d].any(axis=0))[0]
+        region.append(slice(columns[0], columns[-1] + 1))
+        weights[d] = weights[d][:, region[d]]
+    array = sitk.GetArrayViewFromImage(image)
+    input_dtype = array.dtype
+    roi = array[region[2], region[1], region[0]].astype('float64')
+    # numpy axes are z, y, x
+    out = np.tensordot(roi, weights[0], axes=([2], [1]))
+    out = np.tensordot(out, weights[1], axes=([1], [1]))
+    out = np.tensordot(out, weights[2], axes=([0], [1]))
+    out = out.transpose(2, 1, 0)
+    if not all(axis_inside.all() for axis_inside in inside):
+        if default_value is None:
+            default_value = image_min(image)
+        out[~inside[2], :, :] = default_value
+        out[:, ~inside[1], :] = default_value
+        out[:, :, ~inside[0]] = default_value
+    if np.issubdtype(input_dtype, np.integer):
+        # ResampleImageFilter truncates into the integer range
+        info = np.iinfo(input_dtype)
+        out = np.clip(np.trunc(out), info.min, info.max)
+    resampled = sitk.GetImageFromArray(out.astype(input_dtype))
+    resampled.SetSpacing(new_space.tolist())
+    resampled.SetOrigin(new_org.tolist())
+    resampled.SetDirection(image.GetDirection())
+    return resampled
 
 
 def parse_bbox(bbox, bbox_selected, size, space):
@@ -96,7 +198,8 @@ def parse_bbox(bbox, bbox_selected, size, space):
     return np.asarray([min_x, min_y, min_z]), np.asarray([max_x, max_y, max_z])
 
 
-def crop_w_bbox(image, bbox, bbox_selected):
+def crop_w_bbox(image, bbox, bbox_selected, default_value=None, crop_first=False,
+                interpolator=sitk.sitkGaussian):
     image.SetOrigin((0, 0, 0))
     image.SetDirection((1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
     org_space = np.array(image.GetSpacing())
@@ -109,4 +212,7 @@ def crop_w_bbox(image, bbox, bbox_selected):
         return None
     return calibrate_resizer(
         image, min_point, max_point,
-        np.asarray([128, 128, 128]))
+        np.asarray([128, 128, 128]),
+        default_value=default_value,
+        crop_first=crop_first,
+        interpolator=interpolator)
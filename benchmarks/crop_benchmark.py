@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Compare the full-grid and the crop-before-resample paths of
+# bbox_cut.crop_w_bbox: runtime and largest absolute difference of the 128^3
+# output, on a synthetic thin-slice volume or on a given scan.
+#   python benchmarks/crop_benchmark.py --slices 600
+#   python benchmarks/crop_benchmark.py --input sub-001_ses-01_ct.nii.gz
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bbox_cut import crop_w_bbox  # noqa: E402
+from timing import timeit  # noqa: E402
+from utils import image_min  # noqa: E402
+
+
+def synthetic_volume(slices, spacing, axial_size=512):
+    # Air around a water cylinder with a denser disc in the middle, plus
+    # noise, in int16 HU. The field of view is 358 mm whatever axial_size is.
+    scale = axial_size / 512
+    z, y, x = np.ogrid[:slices, :axial_size, :axial_size]
+    r = np.hypot(x - axial_size / 2, y - axial_size / 2) / scale
+    volume = np.random.default_rng(0).integers(-20, 20, (slices, axial_size, axial_size), dtype='int16')
+    volume += np.where(r < 200, 0, -1000).astype('int16')
+    volume[np.broadcast_to((r < 60) & (np.abs(z - slices / 2) < slices / 4), volume.shape)] += 300
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing((0.7 / scale, 0.7 / scale, spacing))
+    return image
+
+
+def heart_bbox(num_slices):
+    # Detector-like output: one box per slice from the last slice down
+    bbox = np.zeros((num_slices, 4))
+    bbox[num_slices // 5:num_slices * 4 // 5] = [170, 180, 340, 350]
+    bbox_selected = (bbox.sum(1) > 0).astype('float')
+    return bbox, bbox_selected
+
+
+def run(image, bbox, bbox_selected, crop_first, repeat):
+    default_value = image_min(image)
+    cropped, timing = timeit(
+        lambda: crop_w_bbox(image, bbox, bbox_selected, default_value, crop_first=crop_first), repeat)
+    return sitk.GetArrayFromImage(cropped), timing['seconds']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='crop_w_bbox benchmark')
+    parser.add_argument('--input', default=None, type=str,
+                        help='input: NIfTI scan to crop, resized to 512x512 axially beforehand. Default: synthetic volume')
+    parser.add_argument('--slices', default=600, type=int,
+                        help='slices: number of slices of the synthetic volume. Default: 600')
+    parser.add_argument('--spacing', default=0.5, type=float,
+                        help='spacing: slice spacing of the synthetic volume in mm. Default: 0.5')
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='repeat: timed runs per path, the fastest is reported. Default: 3')
+    parser.add_argument('--json', default=None, type=str,
+                        help='json: file to write the results to. Default: print only')
+    opt = parser.parse_args()
+
+    if opt.input is not None:
+        image = sitk.ReadImage(opt.input)
+        if image.GetSize()[:2] != (512, 512):
+            from image import Image
+            loaded = Image()
+            loaded.load(opt.input)
+            image = loaded.org_ct_img
+    else:
+        image = synthetic_volume(opt.slices, opt.spacing)
+    bbox, bbox_selected = heart_bbox(image.GetSize()[2])
+
+    full, full_time = run(image, bbox, bbox_selected, False, opt.repeat)
+    roi, roi_time = run(image, bbox, bbox_selected, True, opt.repeat)
+    result = {
+        'input': opt.input or 'synthetic',
+        'size': list(image.GetSize()),
+        'full_grid_seconds': full_time,
+        'crop_first_seconds': roi_time,
+        'speedup': full_time / roi_time,
+        'max_abs_diff': float(np.abs(full.astype('float') - roi.astype('float')).max()),
+        'mismatched_fraction': float((full != roi).mean()),
+    }
+    print(json.dumps(result, indent=2))
+    if opt.json is not None:
+        with open(opt.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+# Time every stage of the scoring of a scan on CPU, on synthetic NIfTI
+# volumes and randomly initialized models, so it needs no checkpoint, GPU or
+# network. Results go to a JSON file; pass the file of an earlier version as
+# --baseline to see the change of every stage.
+#   python benchmarks/run_benchmarks.py --json bench.json
+#   python benchmarks/run_benchmarks.py --volumes 100:2.5 --baseline bench.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bbox_cut import crop_w_bbox  # noqa: E402
+from crop_benchmark import heart_bbox, synthetic_volume  # noqa: E402
+from heart_detect import detector, fold_grayscale_input  # noqa: E402
+from image import Image  # noqa: E402
+from init_model import init_model  # noqa: E402
+from retinanet.model import resnet18  # noqa: E402
+from runtime import PRECISIONS, configure_cpu, use_channels_last  # noqa: E402
+from timing import timeit  # noqa: E402
+from utils import INTERPOLATORS, image_min, norm, to_network_input  # noqa: E402
+
+STAGES = ['preprocess', 'detection', 'crop', 'crop_first', 'to_network_input', 'aug_transform']
+
+
+def volume_name(slices, spacing, axial_size):
+    return f'synthetic_{axial_size}x{slices}_{spacing}mm'
+
+
+def volume_path(data_dir, slices, spacing, axial_size):
+    path = os.path.join(data_dir, volume_name(slices, spacing, axial_size) + '.nii.gz')
+    if not os.path.exists(path):
+        sitk.WriteImage(synthetic_volume(slices, spacing, axial_size), path)
+    return path
+
+
+def random_detector(device):
+    # The RetinaNet of retinanet_heart.pt, with random weights
+    model = fold_grayscale_input(resnet18(num_classes=1, pretrained=False)).to(device)
+    if use_channels_last(device):
+        model = model.to(memory_format=torch.channels_last)
+    model.eval()
+    return model
+
+
+def environment(num_threads):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'simpleitk': sitk.Version_VersionString(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'num_threads': num_threads,
+    }
+
+
+def bench_volume(path, opt, heart_detector, stages):
+    results = {}
+    image = Image()
+    if 'preprocess' in stages:
+        def preprocess():
+            loaded = Image()
+            loaded.load(path, profile=opt.preprocess_profile)
+            return loaded
+        image, results['preprocess'] = timeit(preprocess, opt.repeat)
+        results['preprocess']['stages'] = image.timings
+    else:
+        image.load(path, profile=opt.preprocess_profile)
+    num_slices = image.org_npy.shape[0]
+
+    if 'detection' in stages:
+        slices = image.org_npy[:opt.detector_slices]
+        _, results['detection'] = timeit(
+            lambda: detector(slices, model=heart_detector, batch_size=opt.detector_batch_size),
+            opt.repeat)
+        results['detection']['slices'] = len(slices)
+        results['detection']['seconds_per_slice'] = results['detection']['seconds'] / len(slices)
+
+    bbox, bbox_selected = heart_bbox(num_slices)
+    default_value = image_min(image.org_ct_img)
+    cropped = None
+    for name, crop_first in (('crop', False), ('crop_first', True)):
+        if name in stages:
+            cropped, results[name] = timeit(
+                lambda: crop_w_bbox(image.org_ct_img, bbox, bbox_selected, default_value,
+                                    crop_first=crop_first,
+                                    interpolator=INTERPOLATORS[opt.preprocess_profile]),
+                opt.repeat)
+    if 'to_network_input' in stages:
+        if cropped is None:
+            cropped = crop_w_bbox(image.org_ct_img, bbox, bbox_selected, default_value, crop_first=True,
+                                  interpolator=INTERPOLATORS[opt.preprocess_profile])
+        detected_npy = norm(sitk.GetArrayViewFromImage(cropped), -300, 500)
+        _, results['to_network_input'] = timeit(lambda: to_network_input(detected_npy), opt.repeat)
+    return results
+
+
+def compare(results, baseline):
+    # ratio of every stage time to the baseline, > 1 is slower
+    def stage_times(run):
+        times = {}
+        for volume in run['volumes']:
+            for stage, result in volume['stages'].items():
+                times[(volume['name'], stage)] = result['seconds']
+        for stage, result in run.get('model', {}).items():
+            times[('model', stage)] = result['seconds']
+        return times
+
+    old, new = stage_times(baseline), stage_times(results)
+    print(f'{"volume":<28}{"stage":<20}{"baseline":>10}{"current":>10}{"ratio":>8}')
+    for key in new:
+        if key in old:
+            print(f'{key[0]:<28}{key[1]:<20}{old[key]:>10.3f}{new[key]:>10.3f}{new[key] / old[key]:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU benchmark of the scoring stages')
+    parser.add_argument('--volumes', default=['100:2.5', '300:1.0', '600:0.5'], nargs='+', type=str,
+                        help='volumes: synthetic volumes as slices:spacing, spacing in mm. Default: 100:2.5 300:1.0 600:0.5')
+    parser.add_argument('--axial-size', default=512, type=int,
+                        help='axial-size: axial size of the synthetic volumes; other than 512 adds the axial resize to preprocess. Default: 512')
+    parser.add_argument('--stages', default=STAGES, nargs='+', choices=STAGES,
+                        help='stages: stages to time. Default: all')
+    parser.add_argument('--preprocess-profile', default='accurate', type=str, choices=['accurate', 'fast'],
+                        help='preprocess-profile: interpolation of the resize and of the crop. Default: accurate')
+    parser.add_argument('--precision', default='fp32', type=str, choices=PRECISIONS,
+                        help='precision: Tri2DNet precision of aug_transform; other than fp32 also records the largest difference to the fp32 probabilities. Default: fp32')
+    parser.add_argument('--detector-slices', default=32, type=int,
+                        help='detector-slices: slices of each volume run through the detector; seconds_per_slice scales to a whole scan. Default: 32')
+    parser.add_argument('--detector-batch-size', default=4, type=int,
+                        help='detector-batch-size: axial slices per detector forward pass. Default: 4')
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='num-threads: intra-op threads of torch. Default: one per available core')
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='repeat: timed runs per stage, the fastest is reported. Default: 3')
+    parser.add_argument('--data-dir', default=None, type=str,
+                        help='data-dir: directory keeping the synthetic NIfTI files between runs. Default: a temporary directory')
+    parser.add_argument('--json', default=None, type=str,
+                        help='json: file to write the results to. Default: print only')
+    parser.add_argument('--baseline', default=None, type=str,
+                        help='baseline: results of an earlier run to compare with. Default: none')
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device('cpu')
+    num_threads = configure_cpu(opt.num_threads)
+    data_dir = opt.data_dir or tempfile.mkdtemp(prefix='cvdrisk-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    results = {'environment': environment(num_threads), 'options': vars(opt), 'volumes': [], 'model': {}}
+    try:
+        heart_detector = random_detector(device) if 'detection' in opt.stages else None
+        # aug_transform alone needs no volume
+        volumes = opt.volumes if set(opt.stages) - {'aug_transform'} else []
+        for volume in volumes:
+            slices, spacing = volume.split(':')
+            slices, spacing = int(slices), float(spacing)
+            path = volume_path(data_dir, slices, spacing, opt.axial_size)
+            results['volumes'].append({
+                'name': volume_name(slices, spacing, opt.axial_size),
+                'size': [opt.axial_size, opt.axial_size, slices],
+                'spacing': spacing,
+                'stages': bench_volume(path, opt, heart_detector, opt.stages),
+            })
+        if 'aug_transform' in opt.stages:
+            # Tri2DNet sees a 2 x 128^3 volume whatever the scan
+            model = init_model(device, opt.precision)
+            volume = np.random.default_rng(0).random((2, 128, 128, 128), dtype='float32')
+            prob, results['model']['aug_transform'] = timeit(lambda: model.aug_transform(volume), opt.repeat)
+            if opt.precision != 'fp32':
+                model.precision = 'fp32'
+                reference = model.aug_transform(volume)
+                results['model']['aug_transform']['max_abs_diff_fp32'] = float(np.abs(prob - reference).max())
+    finally:
+        if opt.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if opt.json is not None:
+        with open(opt.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if opt.baseline is not None:
+        with open(opt.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Startup cost of a scoring job: time to import cvdrisk_BIDS.py, to build
+# the models and to score a first scan, each run in a fresh interpreter as a
+# per-scan job would. Uses a synthetic volume and random weights, so it needs
+# no checkpoint, GPU or network.
+#   python benchmarks/startup_benchmark.py --json startup.json
+#   python benchmarks/startup_benchmark.py --import-only --repeat 10
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed for --save-maps or training, should not load when scoring
+OPTIONAL_MODULES = ['matplotlib', 'mpl_toolkits', 'cv2', 'skimage', 'pandas', 'scipy', 'data', 'visualization']
+
+
+def measure(opt):
+    # Runs in the child interpreter; the scoring modules must not be imported before
+    start = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    # the import is what is timed, the module itself is not used
+    importlib.import_module('cvdrisk_BIDS')
+    result = {
+        'import_seconds': time.perf_counter() - start,
+        'optional_modules_loaded': [name for name in OPTIONAL_MODULES if name in sys.modules],
+    }
+    if not opt.import_only:
+        import functools
+        import torch
+        from crop_benchmark import heart_bbox
+        from heart_detect import detector
+        from image import Image
+        from init_model import init_model
+        from run_benchmarks import random_detector
+        from runtime import configure_cpu
+
+        device = torch.device('cpu')
+        configure_cpu(opt.num_threads)
+        torch.manual_seed(0)
+        step = time.perf_counter()
+        model = init_model(device, opt.precision)
+        heart_detector = functools.partial(detector, model=random_detector(device), batch_size=4)
+        result['model_init_seconds'] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        image = Image()
+        image.load(opt.child_input, profile=opt.preprocess_profile)
+        image.locate_heart(heart_detector)
+        # random weights find no heart, crop the box a detector would return
+        image.bbox, image.bbox_selected = heart_bbox(image.org_npy.shape[0])
+        image.heart_detected = True
+        image.crop_heart(opt.crop_first, opt.preprocess_profile)
+        model.aug_transform(image.to_network_input())
+        result['first_scan_seconds'] = time.perf_counter() - step
+        result['stages'] = image.timings
+        result['time_to_first_score_seconds'] = time.perf_counter() - start
+    result['optional_modules_loaded_after_score'] = [name for name in OPTIONAL_MODULES if name in sys.modules]
+    with open(opt.child, 'w') as f:
+        json.dump(result, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark of a scoring job')
+    parser.add_argument('--slices', default=100, type=int,
+                        help='slices: number of slices of the synthetic 512x512 volume. Default: 100')
+    parser.add_argument('--spacing', default=2.5, type=float,
+                        help='spacing: slice spacing of the synthetic volume in mm. Default: 2.5')
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='repeat: fresh interpreters to time, the median is reported. Default: 3')
+    parser.add_argument('--import-only', action='store_true',
+                        help='import-only: only time the imports, not the first score')
+    parser.add_argument('--precision', default='fp32', type=str,
+                        help='precision: Tri2DNet precision, fp32 or bf16. Default: fp32')
+    parser.add_argument('--preprocess-profile', default='accurate', type=str, choices=['accurate', 'fast'],
+                        help='preprocess-profile: interpolation of the resize and of the crop. Default: accurate')
+    parser.add_argument('--crop-first', action='store_true',
+                        help='crop-first: resample only the heart bbox region')
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='num-threads: intra-op threads of torch. Default: one per available core')
+    parser.add_argument('--json', default=None, type=str,
+                        help='json: file to write the results to. Default: print only')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--child-input', default=None, help=argparse.SUPPRESS)
+    opt, _ = parser.parse_known_args()
+    if opt.child is not None:
+        measure(opt)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='cvdrisk-startup-')
+    try:
+        input_path = os.path.join(work_dir, 'synthetic.nii.gz')
+        if not opt.import_only:
+            import SimpleITK as sitk
+            from crop_benchmark import synthetic_volume
+            sitk.WriteImage(synthetic_volume(opt.slices, opt.spacing), input_path)
+        runs = []
+        for i in range(opt.repeat):
+            result_path = os.path.join(work_dir, f'run{i}.json')
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', result_path,
+                 '--child-input', input_path] + sys.argv[1:],
+                stdout=subprocess.DEVNULL, check=True)
+            with open(result_path) as f:
+                run = json.load(f)
+            # including the interpreter startup and shutdown
+            run['process_seconds'] = time.perf_counter() - start
+            runs.append(run)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'options': {name: value for name, value in vars(opt).items() if not name.startswith('child')},
+        'runs': runs,
+    }
+    for key in ('import_seconds', 'model_init_seconds', 'first_scan_seconds',
+                'time_to_first_score_seconds', 'process_seconds'):
+        if key in runs[0]:
+            results[key] = statistics.median(run[key] for run in runs)
+    results['optional_modules_loaded'] = runs[0]['optional_modules_loaded']
+    print(json.dumps({k: v for k, v in results.items() if k != 'runs'}, indent=2))
+    if opt.json is not None:
+        with open(opt.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
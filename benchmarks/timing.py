@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+# Wall-clock timing shared by the benchmark scripts
+
+import time
+
+
+def timeit(fn, repeat):
+    # (result of the last run, fastest and all wall times)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, {'seconds': min(times), 'runs': times}
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Exact against shared test-time augmentation of Tri2DNet (--tta) on a
+# synthetic 2 x 128^3 volume: the time of both, the difference of the crop
+# logits and of the averaged probabilities, and a map of the feature cells
+# of every crop that the shared 2D trunks get exactly. Randomly initialized
+# by default; --iter loads a checkpoint from checkpoint/ to see the score
+# differences of the trained weights.
+#   python benchmarks/tta_benchmark.py --json tta.json
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from init_model import init_model  # noqa: E402
+from model import softmax  # noqa: E402
+from runtime import PRECISIONS, autocast, configure_cpu, inference_mode  # noqa: E402
+from timing import timeit  # noqa: E402
+
+# (d, h, w) offsets of the 112^3 crops, in the order of Model.aug_transform_batch
+OFFSETS = [[d, h, w] for d in (0, 16) for h in (0, 16) for w in (0, 16)]
+BRANCHES = ['sagittal', 'coronal', 'axial']
+
+
+def exact_logits(encoder, volume, chunk_size):
+    crops = [volume[:, :, d:d + 112, h:h + 112, w:w + 112] for d, h, w in OFFSETS]
+    pred = [encoder(torch.cat(crops[start:start + chunk_size]))[0].float()
+            for start in range(0, len(crops), chunk_size)]
+    return torch.cat(pred)
+
+
+def feature_maps(encoder, volume, slices, tolerance):
+    """Per branch and in-plane crop offset, which cells of the crop features
+    sliced from the whole slices match those of the crop itself: '.' within
+    tolerance (relative to the largest feature), 'x' beyond. Along the slice
+    axis the features are always exact, so a few slices suffice."""
+    maps = {}
+    branches = (encoder.branch_sagittal, encoder.branch_coronal, encoder.branch_axial)
+    for name, branch, view in zip(BRANCHES, branches, encoder.views(volume)):
+        view = view[:, slices]
+        whole = branch.trunk(view)
+        stride = view.size(-1) // whole.size(-1)
+        maps[name] = {}
+        for r in (0, 16):
+            for c in (0, 16):
+                crop = branch.trunk(view[..., r:r + 112, c:c + 112].contiguous())
+                sliced = whole[..., r // stride:r // stride + crop.size(-2), c // stride:c // stride + crop.size(-1)]
+                # largest difference of every cell over the slices and channels
+                diff = (crop - sliced).abs().amax(dim=(0, 1, 2)) / crop.abs().max()
+                exact = (diff <= tolerance).cpu().numpy()
+                maps[name][f'{r},{c}'] = {
+                    'exact_fraction': float(exact.mean()),
+                    'max_rel_diff': float(diff.max()),
+                    'map': [''.join('.' if e else 'x' for e in row) for row in exact],
+                }
+    return maps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exact and shared test-time augmentation of Tri2DNet')
+    parser.add_argument('--iter', default=None, type=int,
+                        help='iter: checkpoint iteration to load from checkpoint/. Default: random weights')
+    parser.add_argument('--precision', default='fp32', type=str, choices=PRECISIONS,
+                        help='precision: Tri2DNet precision. Default: fp32')
+    parser.add_argument('--chunk-size', default=None, type=int,
+                        help='chunk-size: crops (or slices of as many crops) per forward pass. Default: Model.default_chunk_size')
+    parser.add_argument('--map-slices', default=2, type=int,
+                        help='map-slices: slices of each view compared for the feature maps. Default: 2')
+    parser.add_argument('--tolerance', default=1e-5, type=float,
+                        help='tolerance: largest difference, relative to the largest feature, of a feature cell counted as exact. Default: 1e-5')
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='num-threads: intra-op threads of torch. Default: one per available core')
+    parser.add_argument('--repeat', default=1, type=int,
+                        help='repeat: timed runs of each TTA, the fastest is reported. Default: 1')
+    parser.add_argument('--json', default=None, type=str,
+                        help='json: file to write the results to. Default: print only')
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device('cpu')
+    configure_cpu(opt.num_threads)
+    model = init_model(device, opt.precision)
+    if opt.iter is not None:
+        # checkpoint/ is relative to the repository
+        cwd = os.getcwd()
+        os.chdir(ROOT)
+        model.load_model(opt.iter)
+        os.chdir(cwd)
+    encoder = model.encoder.eval()
+    chunk_size = opt.chunk_size or model.default_chunk_size()
+    volume = torch.from_numpy(np.random.default_rng(0).random((1, 2, 128, 128, 128), dtype='float32'))
+
+    results = {'options': vars(opt)}
+    with inference_mode(), autocast(device, opt.precision):
+        exact, timing = timeit(lambda: exact_logits(encoder, volume, chunk_size), opt.repeat)
+        results['exact_seconds'] = timing['seconds']
+        shared, timing = timeit(
+            lambda: encoder.forward_crops(volume, OFFSETS, 112, chunk_size * 112)[0].float(), opt.repeat)
+        results['shared_seconds'] = timing['seconds']
+        results['speedup'] = results['exact_seconds'] / results['shared_seconds']
+        results['max_abs_diff_logit'] = float((exact - shared).abs().max())
+        prob = [softmax(pred.cpu().numpy(), axis=1).mean(axis=0) for pred in (exact, shared)]
+        results['max_abs_diff_prob'] = float(np.abs(prob[0] - prob[1]).max())
+        middle = 64 - opt.map_slices // 2
+        results['feature_maps'] = feature_maps(
+            encoder, volume, slice(middle, middle + opt.map_slices), opt.tolerance)
+
+    print(json.dumps(results, indent=2))
+    if opt.json is not None:
+        with open(opt.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# On-disk cache of the preprocessed heart volumes, so that re-scoring a cohort
+# (e.g. with another --iter checkpoint) skips reading, resampling, heart
+# detection and cropping. Entries are keyed by the content of the input file
+# and everything the preprocessing depends on, and the least recently used
+# entries are evicted once the cache grows past its size limit.
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+# Bump whenever Image.load/locate_heart/crop_heart change their output
+PREPROCESS_VERSION = 1
+
+
+def file_digest(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PreprocessCache:
+    """Directory of .npz entries holding detected_npy, the bboxes and the heart slices."""
+
+    def __init__(self, cache_dir, max_size_gb=50, params=None):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        params = dict(params or {}, version=PREPROCESS_VERSION)
+        self.params = json.dumps(params, sort_keys=True)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_path):
+        digest = hashlib.sha256(self.params.encode())
+        digest.update(file_digest(input_path).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                entry = {name: entry[name] for name in entry.files}
+            if not entry['heart_detected']:
+                result = {'heart_detected': False}
+            else:
+                result = {
+                    'heart_detected': True,
+                    'detected_npy': entry['detected_npy'],
+                    'bbox': entry['bbox'],
+                    'bbox_selected': entry['bbox_selected'],
+                    'first_heart_slice': int(entry['first_heart_slice']),
+                    'last_heart_slice': int(entry['last_heart_slice']),
+                }
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # missing, evicted or truncated by another process, or written
+            # without some of the fields: a miss, the scan is preprocessed again
+            return None
+        try:
+            # the mtime is the last use for the LRU eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, heart_detected, detected_npy=None, bbox=None, bbox_selected=None,
+            first_heart_slice=None, last_heart_slice=None):
+        if heart_detected:
+            entry = {
+                'heart_detected': True,
+                'detected_npy': detected_npy,
+                'bbox': bbox,
+                'bbox_selected': bbox_selected,
+                'first_heart_slice': first_heart_slice,
+                'last_heart_slice': last_heart_slice,
+            }
+        else:
+            entry = {'heart_detected': False}
+        # write to a temporary file first, so shards sharing the cache never
+        # read a partial entry. The cache is only an optimisation: a failed
+        # write (full disk, removed directory) drops the entry.
+        tmp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **entry)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        try:
+            scan = list(os.scandir(self.cache_dir))
+        except OSError:
+            return
+        for entry in scan:
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
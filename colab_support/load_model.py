@@ -32,7 +32,6 @@ def load_model(m):
             f.write(param.read())
 
     print('Loading model parameters...')
-    m.encoder.load_state_dict(
-        torch.load(param_name))
+    m.load_encoder_state(torch.load(param_name, map_location=m.device))
     print('Model initialized.')
     return m
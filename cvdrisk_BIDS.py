@@ -4,161 +4,189 @@
 
 import argparse
 import os
-import numpy as np
-from init_model import init_model
+import logging
+from cache import PreprocessCache, file_digest
 from image import Image
-import time
-import sys
-import logging 
-import re
-import matplotlib.pyplot as plt
-import csv
-
-
-parser = argparse.ArgumentParser(description='Prediction')
-parser.add_argument('--iter', default='700', type=int,
-                    help='iter: iteration of the checkpoint to load. Default: 700')
-parser.add_argument('--input-list', default='file_paths.txt', type=str,
-                    help='input-list: path to the text file containing the input file paths. Default: ./file_paths.txt')
-parser.add_argument('--output-dir', default='./derived/pipeline/', type=str,
-                    help='output-dir: directory to save output files. Default: derived/pipeline/')
-parser.add_argument('--cuda-device', default='0', type=str,
-                    help='cuda-device: which CUDA device to use. Default: 0')
-parser.add_argument('--save-maps', action='store_true',
-                    help='save-maps: wheter to save png maps of the detected heart and grad maps of the risk score')
-opt = parser.parse_args()
-
-
-os.makedirs(opt.output_dir, exist_ok=True)
-
-# Define the log file path
-log_file_path = os.path.join(opt.output_dir, 'cvd-risk-score.log')
-if os.path.exists(log_file_path):
-    os.remove(log_file_path)
-    open(log_file_path, 'w').close()
-
-# Add this after your argument parsing and before the main loop
-csv_file_path = os.path.join(opt.output_dir, 'cvd_results.csv')
-csv_headers = ['input_path', 'cvd_risk_score', 'first_heart_slice', 'last_heart_slice', 'status', 'processing_time_seconds']
-
-# Initialize CSV with headers
-with open(csv_file_path, 'w', newline='') as csvfile:
-    writer = csv.writer(csvfile)
-    writer.writerow(csv_headers)
-
-def append_to_csv(csv_path, data_row):
-    """Append a single row of data to the CSV file."""
-    with open(csv_path, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(data_row)
-
-# Configure logging for both console and file separately
-logger = logging.getLogger('cvd-risk-score')
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(log_file_path)
-file_handler.setLevel(logging.INFO)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
-
-# Log parsed arguments
-logger.info(f'Parsed Arguments: {opt}')
-
-os.environ["CUDA_VISIBLE_DEVICES"] = opt.cuda_device
-
-m = init_model()
-m.load_model(opt.iter)
-
-with open(opt.input_list, 'r') as file_paths:
-    for line in file_paths:
-        # Define regular expressions to match 'sub' and 'ses' parts
-        sub_pattern = r'sub-\d+'
-        ses_pattern = r'ses-[A-Za-z0-9]+'
-        input_path = line.strip()  # Remove leading/trailing whitespaces and newline characters
-        logger.info(f'input path: {input_path}')
-        #print('input path', input_path)
-        # Extract 'sub' and 'ses' parts from the file path
-        sub_match = re.search(sub_pattern, input_path)
-        ses_match = re.search(ses_pattern, input_path)
-        if not sub_match or not ses_match:
-            logger.error(f'BIDS format not found in {input_path}')
-            continue
-        sub_part = sub_match.group(0)
-        ses_part = ses_match.group(0)
-        # output files must be stored respecting BIDS structure:
-        # output_dir/sub-XXXXXX/ses-XX/ct
-        output_path = os.path.join(opt.output_dir, sub_part, ses_part, 'ct')
-        os.makedirs(output_path, exist_ok=True)
-        file_name = os.path.basename(input_path)
-        score_file_name = file_name.replace('ct.nii.gz', 'desc-cvdr.txt')
-        score_file_path = os.path.join(output_path, score_file_name)
-        heart_slices_file_name = file_name.replace('ct.nii.gz', 'desc-heartslices.txt')
-        heart_slices_file_path = os.path.join(output_path, heart_slices_file_name) 
-        if opt.save_maps:
-            gradmap_file_name = file_name.replace('ct.nii.gz', 'desc-gradmap.png')
-            gradmap_file_path = os.path.join(output_path, gradmap_file_name)
-        image = Image()
-        start_time = time.time()
-        # Initialize default values for CSV row
-        cvd_risk_score = "N/A"
-        first_heart_slice = "N/A" 
-        last_heart_slice = "N/A"
-        status = "fail"
-        # image.detect_heart(input_path)
-        ## added 27/03
+from init_model import init_model, init_detector
+from model import TTA
+from pipeline import (EVENTS_HEADERS, completed_scans, events_path, index_path, init_csv, init_index,
+                      prepare_scan, profile_path, read_input_list, resources_path, result_paths,
+                      run_pipeline, upgrade_csv)
+from profiling import ResourceSampler
+from runtime import PRECISIONS, configure_cpu, resolve_device
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Prediction')
+    parser.add_argument('--iter', default='700', type=int,
+                        help='iter: iteration of the checkpoint to load. Default: 700')
+    parser.add_argument('--input-list', default='file_paths.txt', type=str,
+                        help='input-list: path to the text file containing the input file paths. Default: ./file_paths.txt')
+    parser.add_argument('--output-dir', default='./derived/pipeline/', type=str,
+                        help='output-dir: directory to save output files. Default: derived/pipeline/')
+    parser.add_argument('--cuda-device', default='0', type=str,
+                        help='cuda-device: which CUDA device to use. Default: 0')
+    parser.add_argument('--device', default=None, type=str,
+                        help='device: torch device to run on, cpu or cuda:N. Overrides --cuda-device. Default: the GPU selected by --cuda-device')
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='num-threads: intra-op threads for CPU inference. Default: one per available core')
+    parser.add_argument('--save-maps', action='store_true',
+                        help='save-maps: wheter to save png maps of the detected heart and grad maps of the risk score')
+    parser.add_argument('--detector-batch-size', default=None, type=int,
+                        help='detector-batch-size: number of axial slices per heart detector forward pass. Default: sized to the free GPU memory')
+    parser.add_argument('--scan-batch-size', default=1, type=int,
+                        help='scan-batch-size: number of scans whose test-time augmentation crops are scored together. Default: 1')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='workers: number of processes reading, resizing and cropping the scans while the models run. 0 runs everything in order in this process. Default: 0')
+    parser.add_argument('--queue-depth', default=4, type=int,
+                        help='queue-depth: number of scans the loading and cropping stages may run ahead of the models, with --workers above 0. Default: 4')
+    parser.add_argument('--write-queue', default=8, type=int,
+                        help='write-queue: number of scans whose outputs may wait for the writer thread. Default: 8')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume: skip the scans already scored in output-dir and append to its CSV and log instead of starting them over')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile: write the time of every stage and the peak RSS/device memory of every scan to cvd_results_profile.jsonl')
+    parser.add_argument('--sample-resources', default=None, type=float, metavar='SECONDS',
+                        help='sample-resources: every SECONDS, record the CPU utilization and RSS of the run and the utilization/memory of its GPU to cvd_results_resources.csv, and the start/end and stages of every scan to cvd_results_events.csv. Plot them with plot_gpu.py. Default: off')
+    parser.add_argument('--shard-index', default=0, type=int,
+                        help='shard-index: which shard of the input list to process, lines shard-index, shard-index + num-shards, ... Default: 0')
+    parser.add_argument('--num-shards', default=1, type=int,
+                        help='num-shards: number of shards the input list is split into. Each shard writes its own CSV and log, merged by merge_results.py. Default: 1')
+    parser.add_argument('--detector-input', default='float32', type=str, choices=['float32', 'float16', 'uint8'],
+                        help='detector-input: dtype of the windowed volume fed to the heart detector. float16 and uint8 halve or quarter its memory. Default: float32')
+    parser.add_argument('--preprocess-profile', default='accurate', type=str, choices=['accurate', 'fast'],
+                        help='preprocess-profile: interpolation of the axial resize and of the heart crop, accurate (Gaussian, as the model was trained) or fast (linear). Recorded in the CSV. Default: accurate')
+    parser.add_argument('--precision', default='fp32', type=str, choices=PRECISIONS,
+                        help='precision: Tri2DNet inference precision, fp32, or bf16 (CPU, recent GPUs) / fp16 (GPU) autocast. Recorded in the CSV. Check the scores with validate_precision.py first. Default: fp32')
+    parser.add_argument('--tta', default='exact', type=str, choices=TTA,
+                        help='tta: test-time augmentation of Tri2DNet over its 8 crops, exact (every crop through the whole network) or shared (the 2D trunks run once per slice and the crops slice their features, about 5x faster on CPU but approximate near the crop edges). Recorded in the CSV. Check the scores with validate_tta.py first. Default: exact')
+    parser.add_argument('--runtime', default='eager', type=str, choices=['eager', 'torchscript'],
+                        help='runtime: run Tri2DNet and the heart detector backbone/heads as eager PyTorch modules, or as the frozen TorchScript written by export_models.py to export-dir. torchscript needs --precision fp32. Default: eager')
+    parser.add_argument('--export-dir', default='./exported/', type=str,
+                        help='export-dir: directory of the models exported by export_models.py, for --runtime torchscript. Default: ./exported/')
+    parser.add_argument('--crop-first', action='store_true',
+                        help='crop-first: resample only the heart bbox region, one axis at a time, instead of the full grid. Matches the full-grid crop up to 1 HU of rounding, and is much faster')
+    parser.add_argument('--cache-dir', default=None, type=str,
+                        help='cache-dir: directory caching the cropped heart volumes, so that later runs on the same scans skip preprocessing and heart detection. Default: no cache')
+    parser.add_argument('--cache-size', default=50, type=float,
+                        help='cache-size: size limit of the cache in GB, least recently used entries are evicted beyond it. Default: 50')
+    opt = parser.parse_args()
+    if not 0 <= opt.shard_index < opt.num_shards:
+        parser.error('--shard-index must be in [0, --num-shards)')
+    if opt.sample_resources is not None and opt.sample_resources <= 0:
+        parser.error('--sample-resources must be positive')
+    if opt.runtime == 'torchscript' and opt.precision != 'fp32':
+        parser.error('--runtime torchscript runs in fp32, use --precision fp32')
+    if opt.runtime == 'torchscript' and opt.tta != 'exact':
+        parser.error('--runtime torchscript runs the exact TTA only, use --tta exact')
+    return opt
+
+
+def setup_logger(log_file_path):
+    # Configure logging for both console and file separately
+    logger = logging.getLogger('cvd-risk-score')
+    logger.setLevel(logging.INFO)
+    file_handler = logging.FileHandler(log_file_path)
+    file_handler.setLevel(logging.INFO)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+    return logger
+
+
+def main():
+    opt = parse_args()
+
+    os.makedirs(opt.output_dir, exist_ok=True)
+
+    # Define the CSV and log file paths of this shard
+    csv_file_path, log_file_path = result_paths(opt.output_dir, opt.shard_index, opt.num_shards)
+    if os.path.exists(log_file_path) and not opt.resume:
+        os.remove(log_file_path)
+        open(log_file_path, 'w').close()
+
+    if opt.resume and os.path.exists(csv_file_path):
+        # a CSV of an earlier version gets the columns added since
         try:
-            image.detect_heart(input_path)
-        except RuntimeError as e:
-            logger.error(f'Error processing {input_path}: {e}')
-            with open(score_file_path, 'w') as output_file:
-                output_file.write(f'FAILED HEART DETECTION')
-            
-            # Calculate elapsed time and write to CSV before continuing
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            row = [input_path, cvd_risk_score, first_heart_slice, last_heart_slice, status, elapsed_time]
-            append_to_csv(csv_file_path, row)
-            continue
-        ##
-        if not image.heart_detected:
-            logger.error(f'Heart detection failed for {input_path}. Skipping to the next image.')
-            with open(score_file_path, 'w') as output_file:
-                output_file.write(f'FAILED HEART DETECTION')
-            # Calculate elapsed time and write to CSV before continuing
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            row = [input_path, cvd_risk_score, first_heart_slice, last_heart_slice, status, elapsed_time]
-            append_to_csv(csv_file_path, row)
-            continue
-
-        #image.detect_visual(output_dir=output_path)
-        network_input = image.to_network_input()
-        cvd_risk_score = m.aug_transform(network_input)[1]
-        first_heart_slice = image.first_slice 
-        last_heart_slice = image.last_slice 
-        if opt.save_maps:
-            image_identifier = file_name.replace('_ct.nii.gz', '')
-            image.detect_visual(output_dir=output_path, file_name_suffix=image_identifier)
-            gradmap = m.grad_cam_visual(image.to_network_input())
-            plt.savefig(gradmap_file_path)
-        with open(score_file_path, 'w') as output_file:
-            output_file.write(f'Estimated CVD Risk: {cvd_risk_score}\n')
-        with open(heart_slices_file_path, 'w') as output_file:
-            output_file.write(f'First heart slice: {first_heart_slice}\n')
-            output_file.write(f'Last heart slice: {last_heart_slice}\n')
-
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        status = 'success'
-        row = [input_path, cvd_risk_score, first_heart_slice, last_heart_slice, status, elapsed_time]
-        append_to_csv(csv_file_path, row)
-
-        logger.info(f'Processed {input_path} in {elapsed_time:.2f} seconds. CVD Risk saved to {score_file_path}.')
-
-# Close the log file
-logger.info(f'Log file saved to: {log_file_path}')
-     
\ No newline at end of file
+            upgrade_csv(csv_file_path)
+        except ValueError as e:
+            raise SystemExit(str(e))
+    completed = completed_scans(csv_file_path) if opt.resume else set()
+    # Initialize CSV with headers, unless resuming a run that already has one
+    if not (opt.resume and os.path.exists(csv_file_path)):
+        init_csv(csv_file_path)
+    if not (opt.resume and os.path.exists(index_path(csv_file_path))):
+        init_index(csv_file_path, completed)
+    if opt.profile and not opt.resume:
+        open(profile_path(csv_file_path), 'w').close()
+    sampling = opt.sample_resources is not None
+    if sampling and not (opt.resume and os.path.exists(events_path(csv_file_path))):
+        init_csv(events_path(csv_file_path), EVENTS_HEADERS)
+
+    logger = setup_logger(log_file_path)
+
+    # Log parsed arguments
+    logger.info(f'Parsed Arguments: {opt}')
+
+    if opt.device is None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = opt.cuda_device
+    device = resolve_device(opt.device)
+    if device.type == 'cpu':
+        logger.info(f'Running on CPU with {configure_cpu(opt.num_threads)} threads')
+
+    m = init_model(device, opt.precision, tta=opt.tta)
+    m.load_model(opt.iter)
+    export_dir = None
+    if opt.runtime == 'torchscript':
+        export_dir = opt.export_dir
+        m.load_scripted(export_dir, opt.iter)
+    heart_detector = init_detector(opt.detector_batch_size, device, export_dir)
+
+    preprocess = {
+        'detector_dtype': opt.detector_input,
+        'crop_first': opt.crop_first,
+        'profile': opt.preprocess_profile,
+    }
+    cache = None
+    if opt.cache_dir is not None:
+        params = dict(
+            preprocess,
+            # the pickle, or the export run instead of it with --runtime torchscript
+            detector=file_digest(heart_detector.path),
+            axial_size=Image.CT_AXIAL_SIZE)
+        if opt.runtime != 'eager':
+            # the exported heads match the eager ones up to float rounding
+            params['detector_runtime'] = opt.runtime
+        cache = PreprocessCache(opt.cache_dir, opt.cache_size, params=params)
+
+    input_paths = read_input_list(opt.input_list, opt.shard_index, opt.num_shards)
+    scans = [prepare_scan(input_path, opt.output_dir, opt.save_maps) for input_path in input_paths]
+    scans = [scan for scan in scans if scan is not None]
+    if opt.resume:
+        logger.info(f'Resuming: skipping {sum(scan["input_path"] in completed for scan in scans)} scans already scored')
+        scans = [scan for scan in scans if scan['input_path'] not in completed]
+
+    sampler = None
+    if sampling:
+        # the samples of a resumed run start over, the events are appended
+        sampler = ResourceSampler(resources_path(csv_file_path), opt.sample_resources, device).start()
+    try:
+        run_pipeline(
+            scans, m, heart_detector, csv_file_path, opt.save_maps,
+            workers=opt.workers, queue_depth=opt.queue_depth,
+            write_queue=opt.write_queue, scan_batch_size=opt.scan_batch_size,
+            cache=cache, preprocess=preprocess, profile=opt.profile, events=sampling)
+    finally:
+        if sampler is not None:
+            sampler.stop()
+
+    # Close the log file
+    logger.info(f'Log file saved to: {log_file_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Export Tri2DNet and the backbone and heads of the heart detector as frozen
+# TorchScript, for cvdrisk_BIDS.py --runtime torchscript, and check the
+# exported models against the eager ones on synthetic input, as loaded by
+# the runtime. The export is specific to the device type and the PyTorch
+# version it was made with.
+#   python export_models.py --iter 700 --device cpu
+#   python export_models.py --check-only --device cpu
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+
+from heart_detect import ScriptedRetinaNet, load_detector, scripted_path
+from init_model import init_model
+from retinanet.model import DetectorHeads
+from runtime import configure_cpu, inference_mode, load_scripted, resolve_device, use_channels_last
+
+MODELS = ['tri2dnet', 'detector']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='TorchScript export')
+    parser.add_argument('--iter', default='700', type=int,
+                        help='iter: iteration of the Tri2DNet checkpoint to export. Default: 700')
+    parser.add_argument('--detector', default='retinanet_heart.pt', type=str,
+                        help='detector: pickled heart detector to export. Default: retinanet_heart.pt')
+    parser.add_argument('--export-dir', default='./exported/', type=str,
+                        help='export-dir: directory to write the exported models and export_report.json to. Default: ./exported/')
+    parser.add_argument('--device', default=None, type=str,
+                        help='device: torch device to export for, cpu or cuda:N; the models only run on its device type. Default: cuda if available')
+    parser.add_argument('--models', default=MODELS, nargs='+', choices=MODELS,
+                        help='models: models to export and check. Default: tri2dnet detector')
+    parser.add_argument('--check-only', action='store_true',
+                        help='check-only: only check the models already in export-dir against the eager ones')
+    parser.add_argument('--no-check', action='store_true',
+                        help='no-check: skip the comparison with the eager models')
+    parser.add_argument('--check-slices', default=8, type=int,
+                        help='check-slices: synthetic 512x512 slices run through both heart detectors. Default: 8')
+    parser.add_argument('--check-crops', default=2, type=int,
+                        help='check-crops: synthetic 2x112^3 crops run through both Tri2DNets. Default: 2')
+    parser.add_argument('--tolerance', default=1e-4, type=float,
+                        help='tolerance: largest difference of the Tri2DNet probabilities and of the detector heads outputs and scores to the eager models. Default: 1e-4')
+    parser.add_argument('--box-tolerance', default=0.01, type=float,
+                        help='box-tolerance: largest difference of the detector boxes to the eager model, in pixels. Default: 0.01')
+    parser.add_argument('--num-threads', default=None, type=int,
+                        help='num-threads: intra-op threads for CPU inference. Default: one per available core')
+    opt = parser.parse_args()
+    if opt.check_only and opt.no_check:
+        parser.error('--check-only and --no-check exclude each other')
+    return opt
+
+
+def freeze(module, example):
+    """Trace module on example and freeze it: the weights become constants
+    and the batch norms are folded into the convolutions."""
+    with torch.no_grad():
+        # tensor sizes are recorded as operations, so any batch size runs
+        traced = torch.jit.trace(module, example, check_trace=False)
+    return torch.jit.freeze(traced)
+
+
+def detector_input(batch_size, device, seed=0):
+    # grey level slices in [0, 1], as detector() feeds them
+    generator = torch.Generator().manual_seed(seed)
+    img_batch = torch.rand((batch_size, 1, 512, 512), generator=generator).to(device)
+    if use_channels_last(device):
+        return img_batch.contiguous(memory_format=torch.channels_last)
+    return img_batch
+
+
+def tri2dnet_input(batch_size, device, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand((batch_size, 2, 112, 112, 112), generator=generator).to(device)
+
+
+def timed_call(fn, *args):
+    # one warm-up run: the first runs of a TorchScript module profile and
+    # optimize the graph
+    fn(*args)
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def max_abs_diff(a, b):
+    return float((a.float() - b.float()).abs().max()) if a.numel() > 0 else 0.0
+
+
+def check_detector(retinanet, scripted, opt, device):
+    # the example batch of the trace was 1 slice, check another batch size
+    img_batch = detector_input(opt.check_slices, device, seed=1)
+    with inference_mode():
+        # the heads outputs of every anchor, before the NMS keeps a few
+        classification, regression = DetectorHeads(retinanet).eval()(img_batch)
+        scripted_classification, scripted_regression = scripted.heads(img_batch)
+        (scores, labels, boxes), eager_seconds = timed_call(retinanet.detect, img_batch)
+        (scripted_scores, scripted_labels, scripted_boxes), scripted_seconds = timed_call(
+            scripted.detect, img_batch)
+    # detector() only reads the best detection of every slice
+    result = {
+        'slices': opt.check_slices,
+        'max_abs_diff_classification': max_abs_diff(classification, scripted_classification),
+        'max_abs_diff_regression': max_abs_diff(regression, scripted_regression),
+        'max_abs_diff_score': max_abs_diff(scores[:, 0], scripted_scores[:, 0]),
+        'max_abs_diff_box': max_abs_diff(boxes[:, 0], scripted_boxes[:, 0]),
+        'same_labels': bool(torch.equal(labels[:, 0], scripted_labels[:, 0])),
+        'eager_seconds': eager_seconds,
+        'exported_seconds': scripted_seconds,
+    }
+    result['passed'] = (result['max_abs_diff_classification'] <= opt.tolerance
+                        and result['max_abs_diff_regression'] <= opt.tolerance
+                        and result['same_labels'] and result['max_abs_diff_score'] <= opt.tolerance
+                        and result['max_abs_diff_box'] <= opt.box_tolerance)
+    return result
+
+
+def check_tri2dnet(encoder, scripted, opt, device):
+    volumes = tri2dnet_input(opt.check_crops, device, seed=1)
+    with inference_mode():
+        pred, eager_seconds = timed_call(lambda v: encoder(v)[0], volumes)
+        scripted_pred, scripted_seconds = timed_call(lambda v: scripted(v)[0], volumes)
+    result = {
+        'crops': opt.check_crops,
+        'max_abs_diff_logit': max_abs_diff(pred, scripted_pred),
+        'max_abs_diff_prob': max_abs_diff(torch.softmax(pred, 1), torch.softmax(scripted_pred, 1)),
+        'eager_seconds': eager_seconds,
+        'exported_seconds': scripted_seconds,
+    }
+    result['passed'] = result['max_abs_diff_prob'] <= opt.tolerance
+    return result
+
+
+def main():
+    opt = parse_args()
+    device = resolve_device(opt.device)
+    if device.type == 'cpu':
+        configure_cpu(opt.num_threads)
+    os.makedirs(opt.export_dir, exist_ok=True)
+    report_path = os.path.join(opt.export_dir, 'export_report.json')
+    report = {}
+    if opt.check_only and os.path.isfile(report_path):
+        with open(report_path) as f:
+            report = json.load(f)
+    report.update({'torch': torch.__version__, 'device': device.type})
+
+    if 'detector' in opt.models:
+        path = scripted_path(opt.detector, opt.export_dir, device)
+        retinanet = load_detector(opt.detector, device)
+        if not opt.check_only:
+            print(f'Exporting {opt.detector} to {path}...')
+            freeze(DetectorHeads(retinanet).eval(), detector_input(1, device)).save(path)
+            report['detector'] = {'path': path, 'source': opt.detector}
+        if not opt.no_check:
+            report.setdefault('detector', {'path': path})['check'] = check_detector(
+                retinanet, ScriptedRetinaNet(path, device), opt, device)
+        del retinanet
+
+    if 'tri2dnet' in opt.models:
+        model = init_model(device)
+        model.load_model(opt.iter)
+        model.encoder.eval()
+        path = model.scripted_path(opt.export_dir, opt.iter)
+        if not opt.check_only:
+            print(f'Exporting Tri2DNet iteration {opt.iter} to {path}...')
+            freeze(model.encoder, tri2dnet_input(1, device)).save(path)
+            report['tri2dnet'] = {'path': path, 'iter': opt.iter}
+        if not opt.no_check:
+            report.setdefault('tri2dnet', {'path': path})['check'] = check_tri2dnet(
+                model.encoder, load_scripted(path, device), opt, device)
+
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    failed = [name for name in opt.models if not report[name].get('check', {}).get('passed', True)]
+    if failed:
+        print(f'Exported models differing from the eager ones beyond the tolerances: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
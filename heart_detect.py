@@ -1,22 +1,25 @@
 # -*- coding: utf-8 -*-
 # @Author  : chq_N
 # @Time    : 2020/10/28
-import cv2
 import numpy as np
 import torch
-import zipfile
-from copy import deepcopy
+import torch.nn as nn
 import os.path as osp
-import os
-import retinanet
+import runtime
+from retinanet.model import PostProcess
+from runtime import inference_mode, load_scripted, resolve_device, use_channels_last
 
 def draw_caption(image, box, caption):
+    # cv2 is only loaded when the detection maps are drawn
+    import cv2
     b = np.array(box).astype(int)
     cv2.putText(image, caption, (b[0], b[1] - 10), cv2.FONT_HERSHEY_PLAIN, 1, (0, 0, 0), 2)
     cv2.putText(image, caption, (b[0], b[1] - 10), cv2.FONT_HERSHEY_PLAIN, 1, (255, 255, 255), 1)
 
 def visualize(pic, bbox, caption, selected):
-    pic = (pic * 255).astype('uint8')
+    import cv2
+    if pic.dtype != np.uint8:
+        pic = (pic * 255).astype('uint8')
     draw_caption(pic, bbox, caption)
     x1, y1, x2, y2 = bbox
     if selected:
@@ -63,55 +66,173 @@ def continue_smooth(bbox_selected):
     smoothed_selected[l_idx:r_idx + 1] = 1
     return smoothed_selected
 
-def load_detector():
-    model_name = 'retinanet_heart.pt'
-    model = torch.load(model_name)
+class VisualBbox:
+    """Per-slice pictures of the detected boxes, drawn when indexed.
+
+    Item i is the slice frame_order[i], like the boxes returned by detector,
+    so that only the frames shown by Image.detect_visual are ever drawn.
+    """
+
+    def __init__(self, whole_img, frame_order, bbox_list, scores, selected):
+        self.whole_img = whole_img
+        self.frame_order = frame_order
+        self.bbox_list = bbox_list
+        self.scores = scores
+        self.selected = selected
+
+    def __len__(self):
+        return len(self.frame_order)
+
+    def __getitem__(self, i):
+        pic = np.tile(np.expand_dims(self.whole_img[self.frame_order[i]], axis=2), (1, 1, 3))
+        return visualize(
+            pic, self.bbox_list[i],
+            ': %.3f%%' % (self.scores[i] * 100),
+            self.selected[i])
+
+
+def load_detector(model_name='retinanet_heart.pt', device=None):
+    device = resolve_device(device)
+    model = torch.load(model_name, map_location=device)
+    model = fold_grayscale_input(model).to(device)
+    if use_channels_last(device):
+        model = model.to(memory_format=torch.channels_last)
+    model.eval()
+    return model
+
+
+def fold_grayscale_input(model):
+    # The CT slices are the same grey levels on the 3 input channels, so the
+    # first conv can sum its weights over the channels and read 1 channel
+    conv = model.conv1
+    if conv.in_channels == 1 or conv.groups != 1:
+        return model
+    folded = nn.Conv2d(
+        1, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+        dilation=conv.dilation, bias=conv.bias is not None).to(conv.weight.device)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight.double().sum(1, keepdim=True))
+        if conv.bias is not None:
+            folded.bias.copy_(conv.bias)
+    model.conv1 = folded
     return model
 
-def detector(whole_img):
-    retinanet = load_detector()
+
+def scripted_path(model_name, export_dir, device):
+    # backbone and heads of model_name exported by export_models.py
+    name = osp.splitext(osp.basename(model_name))[0]
+    return osp.join(export_dir, '{}-heads-{}.torchscript.pt'.format(name, device.type))
+
+
+class ScriptedRetinaNet:
+    """Heart detector running the frozen backbone and heads written by
+    export_models.py, with the anchor decoding and NMS in eager PyTorch."""
+
+    # exported after fold_grayscale_input
+    in_channels = 1
+
+    def __init__(self, path, device):
+        self.device = device
+        self.heads = load_scripted(path, device)
+        self.postprocess = PostProcess().to(device)
+
+    def eval(self):
+        return self
+
+    def detect(self, img_batch):
+        classification, regression = self.heads(img_batch)
+        return self.postprocess(img_batch, classification, regression)
+
+
+class HeartDetector:
+    """RetinaNet heart detector loaded once and reused for every scan.
+
+    With export_dir, runs the TorchScript export of model_name instead of
+    the pickled module. path is the file the detector was loaded from.
+    """
+
+    def __init__(self, model_name='retinanet_heart.pt', batch_size=None, device=None, export_dir=None):
+        self.model_name = model_name
+        self.device = resolve_device(device)
+        if export_dir is None:
+            self.path = model_name
+            self.retinanet = load_detector(model_name, self.device)
+        else:
+            self.path = scripted_path(model_name, export_dir, self.device)
+            self.retinanet = ScriptedRetinaNet(self.path, self.device)
+        if batch_size is None:
+            batch_size = default_batch_size(self.device)
+        self.batch_size = batch_size
+
+    def __call__(self, whole_img):
+        return detector(
+            whole_img, model=self.retinanet, batch_size=self.batch_size)
+
+
+def default_batch_size(device):
+    # ~256MB of RetinaNet activations per 512x512 slice
+    return runtime.default_batch_size(
+        device, item_mb=256, max_batch_size=32, cpu_batch_size=4)
+
+
+def detector(whole_img, model=None, batch_size=None, device=None):
+    if model is None:
+        model = load_detector(device=device)
+    if isinstance(model, ScriptedRetinaNet):
+        device, in_channels = model.device, model.in_channels
+    else:
+        device, in_channels = next(model.parameters()).device, model.conv1.in_channels
+    if batch_size is None:
+        batch_size = default_batch_size(device)
     print('Detecting heart...')
-    retinanet = retinanet.cuda()
-    retinanet.eval()
+    model.eval()
 
+    # Slices are visited from the last to the first one, batch_size at a time
     frame_num = whole_img.shape[0]
+    frame_order = list(range(frame_num - 1, -1, -1))
+    # the volume is uploaded once, as it is: float16/uint8 slices are
+    # widened on the device, one batch at a time
+    volume = torch.from_numpy(np.ascontiguousarray(whole_img)).to(device)
+    slice_scores = list()
+    slice_bbox = list()
+    for start in range(0, frame_num, batch_size):
+        # the batch is the slices frame_order[start:start + batch_size], taken
+        # in increasing order as a view and its outputs reversed
+        first = max(0, frame_num - start - batch_size)
+        torch_pic = volume[first:frame_num - start].unsqueeze(1).float()
+        if whole_img.dtype == np.uint8:
+            torch_pic.div_(255)
+        if in_channels != 1:
+            # detector without fold_grayscale_input
+            torch_pic = torch_pic.expand(-1, in_channels, -1, -1)
+        if use_channels_last(device):
+            torch_pic = torch_pic.contiguous(memory_format=torch.channels_last)
+        else:
+            torch_pic = torch_pic.contiguous()
+
+        with inference_mode():
+            scores, labels, boxes = model.detect(torch_pic)
+        # detections are sorted by score and padded with zero score/box, so
+        # the first one is the best box of the slice, or zeros if there is none
+        slice_scores.extend(scores[:, 0].data.cpu().numpy()[::-1])
+        slice_bbox.extend(boxes[:, 0, :].data.cpu().numpy()[::-1])
+
     bbox_list = list()
     bbox_selected = list()
-    visual_bbox = list()
-    for j in range(frame_num - 1, -1, -1):
-        pic = np.tile(np.expand_dims(whole_img[j], axis=2), (1, 1, 3))
-        torch_pic = torch.Tensor(pic).cuda().float()
-        torch_pic = torch_pic.unsqueeze(0).permute(0, 3, 1, 2).contiguous()
-
-        with torch.no_grad():
-            scores, classification, transformed_anchors = retinanet(torch_pic)
-            scores = scores.data.cpu().numpy()
-            transformed_anchors = transformed_anchors.data.cpu().numpy()
-            if scores.size == 0:
-                scores = np.asarray([0])
-                transformed_anchors = np.asarray([[0, 0, 0, 0]])
-            bbox_id = np.argmax(scores)
-            bbox = np.array(transformed_anchors[bbox_id, :])
-            bbox_list.append(bbox)
-
-            score = scores[bbox_id]
-            if score > 0.3:
-                selected = 1
-            elif np.sum(bbox_selected) <= 0:
-                selected = 0
-            elif bbox_selected[-1] == 1 and calc_iou(
-                    bbox_list[-2], bbox_list[-1]) > 0.8 and score > 0.07:
-                selected = 1
-            else:
-                selected = 0
-            bbox_selected.append(selected)
-
-            visual_bbox.append(
-                visualize(
-                    deepcopy(pic), bbox,
-                    ': %.3f%%' % (score * 100),
-                    selected))
+    for score, bbox in zip(slice_scores, slice_bbox):
+        bbox_list.append(bbox)
+        if score > 0.3:
+            selected = 1
+        elif np.sum(bbox_selected) <= 0:
+            selected = 0
+        elif bbox_selected[-1] == 1 and calc_iou(
+                bbox_list[-2], bbox_list[-1]) > 0.8 and score > 0.07:
+            selected = 1
+        else:
+            selected = 0
+        bbox_selected.append(selected)
 
+    visual_bbox = VisualBbox(whole_img, frame_order, bbox_list, slice_scores, bbox_selected)
     bbox_list = np.array(bbox_list)
     bbox_selected = continue_smooth(bbox_selected)
     return bbox_list, bbox_selected, visual_bbox
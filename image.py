@@ -1,18 +1,14 @@
 # -*- coding: utf-8 -*-
 # @Author  : chq_N
 # @Time    : 2020/10/28
-import io
 import os
-import os.path as osp
 import SimpleITK as sitk
 sitk.ProcessObject.SetGlobalDefaultThreader("platform")
-import matplotlib.pyplot as plt
 import numpy as np
-from mpl_toolkits.axes_grid1 import ImageGrid
-from scipy.ndimage import gaussian_filter
 from bbox_cut import crop_w_bbox
 from heart_detect import detector
-from utils import norm, CT_resize
+from profiling import timed
+from utils import INTERPOLATORS, norm, CT_resize, image_min, to_network_input
 
 
 class Image:
@@ -20,6 +16,8 @@ class Image:
 
     def __init__(self):
         self.org_ct_img = None
+        self.org_npy = None
+        self.min_value = None
         self.bbox = None
         self.bbox_selected = None
         self.visual_bbox = None
@@ -28,10 +26,36 @@ class Image:
         self.heart_detected = None # added by Giulia
         self.first_slice = None  # added by Giulia, 25/03
         self.last_slice = None   # added by Giulia, 25/03
+        self.timings = {}  # seconds spent in each preprocessing stage
 
-    def detect_heart(self, file_path):
-        self.org_ct_img = sitk.ReadImage(file_path)
+    def __getstate__(self):
+        # SimpleITK images travel between pipeline processes as arrays
+        state = self.__dict__.copy()
+        for key in ('org_ct_img', 'detected_ct_img'):
+            if state[key] is not None:
+                state[key] = _sitk_to_state(state[key])
+        return state
+
+    def __setstate__(self, state):
+        for key in ('org_ct_img', 'detected_ct_img'):
+            if state[key] is not None:
+                state[key] = _sitk_from_state(state[key])
+        self.__dict__.update(state)
+
+    def detect_heart(self, file_path, heart_detector=None, detector_dtype='float32',
+                     crop_first=False, profile='accurate'):
+        self.load(file_path, detector_dtype, profile)
+        self.locate_heart(heart_detector)
+        self.crop_heart(crop_first, profile)
+
+    def load(self, file_path, detector_dtype='float32', profile='accurate'):
+        # detector_dtype: float32, or float16/uint8 for a smaller detector input
+        # profile: accurate (Gaussian) or fast (linear) resampling
+        with timed(self.timings, 'read'):
+            self.org_ct_img = sitk.ReadImage(file_path)
         print('detect_heart file path', file_path)
+        # fill value of both resamples of the scan
+        self.min_value = image_min(self.org_ct_img)
 
         # Resize org ct
         old_size = np.asarray(self.org_ct_img.GetSize()).astype('float')
@@ -42,15 +66,23 @@ class Image:
             ).astype('float')
             old_space = np.asarray(self.org_ct_img.GetSpacing()).astype('float')
             new_space = old_space * old_size / new_size
-            self.org_ct_img = CT_resize(
-                self.org_ct_img,
-                new_size=new_size.astype('int').tolist(),
-                new_space=new_space.tolist())
-        self.org_npy = sitk.GetArrayFromImage(self.org_ct_img)
-        self.org_npy = norm(self.org_npy, -500, 500)
-        
+            with timed(self.timings, 'resize'):
+                self.org_ct_img = CT_resize(
+                    self.org_ct_img,
+                    new_size=new_size.astype('int').tolist(),
+                    new_space=new_space.tolist(),
+                    default_value=self.min_value,
+                    interpolator=INTERPOLATORS[profile])
+        with timed(self.timings, 'normalize'):
+            self.org_npy = norm(
+                sitk.GetArrayViewFromImage(self.org_ct_img), -500, 500, dtype=detector_dtype)
+
+    def locate_heart(self, heart_detector=None):
         # detect heart
-        self.bbox, self.bbox_selected, self.visual_bbox = detector(self.org_npy)
+        if heart_detector is None:
+            heart_detector = detector
+        with timed(self.timings, 'detection'):
+            self.bbox, self.bbox_selected, self.visual_bbox = heart_detector(self.org_npy)
 
         # modified by Giulia
         if self.bbox is None or self.bbox_selected is None:  # Heart detection failed
@@ -59,28 +91,36 @@ class Image:
             self.heart_detected = False
         else:
             self.heart_detected = True
-            #print('visual bbox', self.visual_bbox)
+
+    def crop_heart(self, crop_first=False, profile='accurate'):
+        # crop_first: resample only the bbox region, see bbox_cut.crop_resample
+        if not self.heart_detected:
+            return
+        #print('visual bbox', self.visual_bbox)
+        with timed(self.timings, 'crop'):
             self.detected_ct_img = crop_w_bbox(
-            self.org_ct_img, self.bbox, self.bbox_selected)
-            #print('detected ct img', self.detected_ct_img)
-            ##
+                self.org_ct_img, self.bbox, self.bbox_selected, self.min_value,
+                crop_first=crop_first, interpolator=INTERPOLATORS[profile])
+        #print('detected ct img', self.detected_ct_img)
+        ##
         # Check if crop_w_bbox failed
-            if self.detected_ct_img is None:
-        #        print('crop_w_bbox failed to return a valid SimpleITK image.')
-                self.detected_npy = None
-                self.heart_detected = False
-            else:
-                self.detected_npy = sitk.GetArrayFromImage(self.detected_ct_img)
-                self.detected_npy = norm(self.detected_npy, -300, 500)
+        if self.detected_ct_img is None:
+        #    print('crop_w_bbox failed to return a valid SimpleITK image.')
+            self.detected_npy = None
+            self.heart_detected = False
+        else:
+            with timed(self.timings, 'normalize'):
+                self.detected_npy = norm(
+                    sitk.GetArrayViewFromImage(self.detected_ct_img), -300, 500)
         #
-                ## added 25/03 by Giulia, to extract indices of sliced where heart is detected
-                # nonzero is a tuple of two arrays so i select just the first one
-                nonzero = np.nonzero(self.bbox)[0]
-                self.first_slice = np.min(nonzero)
-                self.last_slice = np.max(nonzero)
-                #print("Heart detect, first slice:", self.first_slice)
-                #print("Heart detect, last slice:", self.last_slice)
-                ##
+            ## added 25/03 by Giulia, to extract indices of sliced where heart is detected
+            # nonzero is a tuple of two arrays so i select just the first one
+            nonzero = np.nonzero(self.bbox)[0]
+            self.first_slice = np.min(nonzero)
+            self.last_slice = np.max(nonzero)
+            #print("Heart detect, first slice:", self.first_slice)
+            #print("Heart detect, last slice:", self.last_slice)
+            ##
 
         ## previous code    
         #self.detected_ct_img = crop_w_bbox(
@@ -98,7 +138,11 @@ class Image:
 
     # modified by Giulia           
     # def detect_visual(self, output_dir=None):
-    def detect_visual(self, output_dir=None, file_name_suffix=""):
+    def detect_visual(self, output_dir=None, file_name_suffix="", fileobj=None):
+            # matplotlib is only loaded when the maps are drawn
+            import matplotlib.pyplot as plt
+            from mpl_toolkits.axes_grid1 import ImageGrid
+
             total_img_num = len(self.visual_bbox)
             fig = plt.figure(figsize=(15, 15))
             grid = ImageGrid(fig, 111, nrows_ncols=(8, 8), axes_pad=0.05)
@@ -111,15 +155,29 @@ class Image:
             if output_dir:
                 output_file = os.path.join(output_dir, output_file)
             
-            # Save the image to the specified output file
-            plt.savefig(output_file, bbox_inches="tight")
+            # Save the image to the specified output file, or to fileobj
+            if fileobj is not None:
+                output_file = fileobj
+            plt.savefig(output_file, bbox_inches="tight", format="png")
             plt.close()
 
-    def to_network_input(self):
-        data = self.detected_npy
-        mask = np.clip(
-            (data > 0.1375).astype('float') * (data < 0.3375).astype('float')
-            + (data > 0.5375).astype('float'), 0, 1)
-        mask = gaussian_filter(mask, sigma=3)
-        network_input = np.stack([data, data * mask]).astype('float32')
-        return network_input
+    def to_network_input(self, out=None, device=None):
+        with timed(self.timings, 'mask'):
+            return to_network_input(self.detected_npy, out=out, device=device)
+
+
+def _sitk_to_state(image):
+    return {
+        'array': sitk.GetArrayFromImage(image),
+        'spacing': image.GetSpacing(),
+        'origin': image.GetOrigin(),
+        'direction': image.GetDirection(),
+    }
+
+
+def _sitk_from_state(state):
+    image = sitk.GetImageFromArray(state['array'])
+    image.SetSpacing(state['spacing'])
+    image.SetOrigin(state['origin'])
+    image.SetDirection(state['direction'])
+    return image
@@ -1,6 +1,7 @@
+from heart_detect import HeartDetector
 from model import Model
 
-def init_model():
+def init_model(device=None, precision='fp32', inference_only=True, tta='exact'):
     # Initialize model
     print('Initializing model...')
     model_config = {
@@ -24,4 +25,10 @@ def init_model():
         '{}'.format(model_config['batch_size']),
     ])
 
-    return Model(**model_config)
\ No newline at end of file
+    return Model(device=device, precision=precision, inference_only=inference_only, tta=tta, **model_config)
+
+
+def init_detector(batch_size=None, device=None, export_dir=None):
+    # Load the heart detector once for the whole run
+    print('Initializing heart detector...')
+    return HeartDetector('retinanet_heart.pt', batch_size=batch_size, device=device, export_dir=export_dir)
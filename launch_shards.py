@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Run cvdrisk_BIDS.py as one shard per GPU or per block of CPU cores on this
+# machine, then merge the shard results. Arguments that are not listed below
+# are passed on to every shard, e.g.
+#   python launch_shards.py --devices cuda:0,cuda:1 --input-list file_paths.txt --save-maps
+#   python launch_shards.py --devices cpu --input-list file_paths.txt --workers 2
+# Shards on other machines sharing the output dir are started by hand with
+# --shard-index/--num-shards and merged with merge_results.py.
+
+import argparse
+import os
+import subprocess
+import sys
+from pipeline import merge_results, result_paths
+
+
+def cpu_sockets(cores):
+    # Group the usable cores by physical package, one group per socket
+    sockets = {}
+    for core in sorted(cores):
+        path = f'/sys/devices/system/cpu/cpu{core}/topology/physical_package_id'
+        try:
+            with open(path) as f:
+                socket = int(f.read())
+        except OSError:
+            socket = 0
+        sockets.setdefault(socket, []).append(core)
+    return [sockets[socket] for socket in sorted(sockets)]
+
+
+def cpu_blocks(num_blocks=None):
+    cores = sorted(os.sched_getaffinity(0))
+    if num_blocks is None:
+        return cpu_sockets(cores)
+    num_blocks = min(num_blocks, len(cores))
+    # contiguous blocks keep hyperthreads and cache neighbours together
+    size, extra = divmod(len(cores), num_blocks)
+    blocks, start = [], 0
+    for i in range(num_blocks):
+        end = start + size + (i < extra)
+        blocks.append(cores[start:end])
+        start = end
+    return blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded prediction on the local devices')
+    parser.add_argument('--devices', default='cpu', type=str,
+                        help='devices: comma separated devices to run one shard on each, e.g. cuda:0,cuda:1, or cpu. Default: cpu')
+    parser.add_argument('--cpu-shards', default=None, type=int,
+                        help='cpu-shards: with --devices cpu, number of shards the usable cores are split into. Default: one per CPU socket')
+    parser.add_argument('--input-list', default='file_paths.txt', type=str,
+                        help='input-list: path to the text file containing the input file paths. Default: ./file_paths.txt')
+    parser.add_argument('--output-dir', default='./derived/pipeline/', type=str,
+                        help='output-dir: directory to save output files. Default: derived/pipeline/')
+    opt, shard_args = parser.parse_known_args()
+
+    devices = opt.devices.split(',')
+    if devices == ['cpu']:
+        blocks = cpu_blocks(opt.cpu_shards)
+        devices = ['cpu'] * len(blocks)
+    else:
+        blocks = [None] * len(devices)
+    num_shards = len(devices)
+    os.makedirs(opt.output_dir, exist_ok=True)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cvdrisk_BIDS.py')
+
+    processes = []
+    for shard_index, (device, cores) in enumerate(zip(devices, blocks)):
+        command = [sys.executable, script,
+                   '--input-list', opt.input_list, '--output-dir', opt.output_dir,
+                   '--device', device,
+                   '--shard-index', str(shard_index), '--num-shards', str(num_shards)]
+        preexec_fn = None
+        if cores is not None:
+            command += ['--num-threads', str(len(cores))]
+            preexec_fn = (lambda cores=cores: os.sched_setaffinity(0, cores))
+        command += shard_args
+        print(f'Shard {shard_index}/{num_shards} on {device}'
+              + (f' cores {cores[0]}-{cores[-1]}' if cores else ''))
+        processes.append(subprocess.Popen(command, preexec_fn=preexec_fn))
+
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    for shard_index in failed:
+        print(f'Shard {shard_index} failed, see {result_paths(opt.output_dir, shard_index, num_shards)[1]}')
+    missing = merge_results(opt.input_list, opt.output_dir, num_shards)
+    print(f'Merged {num_shards} shards into {opt.output_dir}, {len(missing)} inputs without a result')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
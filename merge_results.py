@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+# Merge the per-shard CSVs of a sharded run into a single cvd_results.csv
+
+import argparse
+from pipeline import merge_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge shard results')
+    parser.add_argument('--input-list', default='file_paths.txt', type=str,
+                        help='input-list: input list the shards were run on, sets the row order. Default: ./file_paths.txt')
+    parser.add_argument('--output-dir', default='./derived/pipeline/', type=str,
+                        help='output-dir: output directory shared by the shards. Default: derived/pipeline/')
+    parser.add_argument('--num-shards', required=True, type=int,
+                        help='num-shards: number of shards of the run')
+    opt = parser.parse_args()
+    try:
+        missing = merge_results(opt.input_list, opt.output_dir, opt.num_shards)
+    except ValueError as e:
+        # shards whose columns cannot be matched
+        raise SystemExit(str(e))
+    print(f'Merged {opt.num_shards} shards into {opt.output_dir}, {len(missing)} inputs without a result')
+    for input_path in missing:
+        print(f'  missing: {input_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,23 +6,30 @@ import os.path as osp
 import sys
 from datetime import datetime
 
-import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import torch.utils.data as tordata
-from mpl_toolkits.axes_grid1 import ImageGrid
-from scipy.ndimage import gaussian_filter
 # from apex import amp
-from scipy.special import softmax
-from skimage.transform import resize as imresize
 
-from data import SoftmaxSampler
 from net import Tri2DNet, Branch
-from visualization import GradCam
+from runtime import autocast, default_batch_size, inference_mode, load_scripted, resolve_device, use_channels_last
+
+# Plotting, Grad-CAM and the training data pipeline are imported where they
+# are used, so that scoring does not load matplotlib, cv2, skimage or pandas
+
+
+# Test-time augmentation of aug_transform_batch: every crop through the
+# whole Tri2DNet, or the 2D trunks shared by the crops (Tri2DNet.forward_crops)
+TTA = ['exact', 'shared']
+
+
+def softmax(x, axis):
+    # scipy.special.softmax
+    exp_x = np.exp(x - np.amax(x, axis=axis, keepdims=True))
+    return exp_x / np.sum(exp_x, axis=axis, keepdims=True)
 
 
 class Model:
@@ -40,7 +47,11 @@ class Model:
             val_source,
             test_source,
             accumulate_steps,
-            prt_path, ):
+            prt_path,
+            device=None,
+            precision='fp32',
+            inference_only=False,
+            tta='exact', ):
 
         self.dout = dout
         self.lr = lr
@@ -55,9 +66,41 @@ class Model:
         self.test_source = test_source
         self.accumulate_steps = accumulate_steps
         self.prt_path = prt_path
+        self.device = resolve_device(device)
+        # fp32, or bf16/fp16 autocast in aug_transform_batch; fails early
+        # when the device or PyTorch cannot run it
+        autocast(self.device, precision)
+        self.precision = precision
+        if tta not in TTA:
+            raise ValueError('Unknown TTA {}'.format(tta))
+        self.tta = tta
+        # set by load_scripted
+        self.scripted_encoder = None
+
+        encoder = Tri2DNet(dout=self.dout).to(self.device)
+        if use_channels_last(self.device):
+            encoder = encoder.to(memory_format=torch.channels_last)
+        if inference_only:
+            # scoring needs neither the loss nor the optimizer, and runs on
+            # one device without the nn.DataParallel scatter/gather
+            self.encoder = encoder
+            self.ce = None
+            self.optimizer = None
+        else:
+            self.init_training(encoder)
+
+        self.loss = []
+        self.m_loss = []
+        self.td_loss = []
+        self.sa_loss = []
+        self.co_loss = []
+        self.ax_loss = []
+        self.f_list = []
+        self.label_list = []
+        self.LOSS = []
 
-        encoder = Tri2DNet(dout=self.dout).cuda()
-        ce = nn.CrossEntropyLoss(reduction='none').cuda()
+    def init_training(self, encoder):
+        ce = nn.CrossEntropyLoss(reduction='none').to(self.device)
 
         att_id = []
         aux_id = []
@@ -82,22 +125,24 @@ class Model:
 
         models = [encoder, ce]
         # models, optimizer = amp.initialize(models, optimizer, opt_level="O1")
-        self.encoder = nn.DataParallel(models[0])
-        self.ce = nn.DataParallel(models[1])
+        if self.device.type == 'cuda':
+            # training uses every visible GPU; the module lives on the first
+            # one of device_ids, so the requested device goes first
+            device_ids = [self.device.index] + [
+                i for i in range(torch.cuda.device_count()) if i != self.device.index]
+            self.encoder = nn.DataParallel(models[0], device_ids=device_ids)
+            self.ce = nn.DataParallel(models[1], device_ids=device_ids)
+        else:
+            # nn.DataParallel cannot hold a CPU module when CUDA is visible
+            self.encoder = models[0]
+            self.ce = models[1]
         self.optimizer = optimizer
         # self.scheduler = optim.lr_scheduler.MultiStepLR(self.optimizer, [8000], gamma=0.5)
 
-        self.loss = []
-        self.m_loss = []
-        self.td_loss = []
-        self.sa_loss = []
-        self.co_loss = []
-        self.ax_loss = []
-        self.f_list = []
-        self.label_list = []
-        self.LOSS = []
-
     def fit(self):
+        import matplotlib.pyplot as plt
+        from data import SoftmaxSampler
+
         if self.restore_iter != 0:
             self.load_model()
 
@@ -118,13 +163,13 @@ class Model:
             self.optimizer.zero_grad()
 
             (pred, aux_pred_sagittal, aux_pred_coronal,
-             aux_pred_axial) = self.encoder(volumes.cuda())
+             aux_pred_axial) = self.encoder(volumes.to(self.device))
 
-            labels = (labels > 0).int()
-            main_ce_loss = self.ce(pred, labels.cuda().long()).mean()
-            sagittal_ce_loss = self.ce(aux_pred_sagittal, labels.cuda().long()).mean()
-            axial_ce_loss = self.ce(aux_pred_axial, labels.cuda().long()).mean()
-            coronal_ce_loss = self.ce(aux_pred_coronal, labels.cuda().long()).mean()
+            labels = (labels > 0).int().to(self.device)
+            main_ce_loss = self.ce(pred, labels.long()).mean()
+            sagittal_ce_loss = self.ce(aux_pred_sagittal, labels.long()).mean()
+            axial_ce_loss = self.ce(aux_pred_axial, labels.long()).mean()
+            coronal_ce_loss = self.ce(aux_pred_coronal, labels.long()).mean()
             total_loss = (main_ce_loss + sagittal_ce_loss + axial_ce_loss + coronal_ce_loss) / 4
             _total_loss = total_loss.cpu().data.numpy()
             self.loss.append(_total_loss)
@@ -200,7 +245,7 @@ class Model:
         with torch.no_grad():
             for i, x in enumerate(data_loader):
                 volumes, labels = x
-                volumes = volumes.cuda()
+                volumes = volumes.to(self.device)
                 b_s = volumes.size()[0]
                 _v = []
                 for _c in crop:
@@ -224,7 +269,24 @@ class Model:
     def aug_transform(self, volumes):
         if isinstance(volumes, np.ndarray):
             volumes = torch.from_numpy(volumes)
+        return self.aug_transform_batch(volumes.unsqueeze(0))[0]
+
+    def aug_transform_batch(self, volumes, chunk_size=None):
+        # volumes: K preprocessed 2 x 128 x 128 x 128 volumes, as a list or
+        # a K x 2 x 128 x 128 x 128 array. Returns K x 2 class probabilities,
+        # each averaged over the 8 crops of the test-time augmentation.
+        # chunk_size crops, or the slices of as many crops with the shared
+        # TTA, run through the network at a time.
+        if isinstance(volumes, (list, tuple)):
+            volumes = [torch.from_numpy(v) if isinstance(v, np.ndarray) else v
+                       for v in volumes]
+            volumes = torch.stack(volumes)
+        elif isinstance(volumes, np.ndarray):
+            volumes = torch.from_numpy(volumes)
         self.encoder.eval()
+        encoder = self.encoder if self.scripted_encoder is None else self.scripted_encoder
+        if chunk_size is None:
+            chunk_size = self.default_chunk_size()
 
         crop = []
 
@@ -238,24 +300,48 @@ class Model:
 
         get_crop([])
 
-        with torch.no_grad():
-            volumes = volumes.cuda()
-            volumes = volumes.unsqueeze(0)
-            _v = []
-            for _c in crop:
-                s = _c[0]
-                h = _c[1]
-                w = _c[2]
-                _v.append(volumes[:, :, s:s + 112, h:h + 112, w:w + 112])
-            _v = torch.cat(_v, 0).contiguous()
-            (pred, aux_pred_sagittal, aux_pred_coronal,
-             aux_pred_axial) = self.encoder(_v)
-            pred = pred.view(len(crop), 2)
-            pred_prob = softmax(pred.data.cpu().numpy(), axis=1).mean(axis=0)
+        with inference_mode():
+            volumes = volumes.to(self.device).contiguous()
+            k, c, d, h, w = volumes.size()
+            pred = []
+            if self.tta == 'shared':
+                # the 2D trunks run once on every slice of a volume, see
+                # Tri2DNet.forward_crops
+                for _k in range(k):
+                    with autocast(self.device, self.precision):
+                        pred.append(self.encoder.forward_crops(
+                            volumes[_k:_k + 1], crop, 112, chunk_size * 112)[0].float())
+            else:
+                s_k, s_c, s_d, s_h, s_w = volumes.stride()
+                # K x 2 x 2 x 2 x C x 112^3 view holding every crop of every
+                # volume, in the same (s, h, w) order as get_crop
+                crops = volumes.as_strided(
+                    (k, 2, 2, 2, c, 112, 112, 112),
+                    (s_k, 16 * s_d, 16 * s_h, 16 * s_w, s_c, s_d, s_h, s_w))
+                index = [(_k,) + tuple(_c[i] // 16 for i in range(3))
+                         for _k in range(k) for _c in crop]
+                for start in range(0, len(index), chunk_size):
+                    _v = torch.stack([crops[_i] for _i in index[start:start + chunk_size]])
+                    with autocast(self.device, self.precision):
+                        pred.append(encoder(_v)[0].float())
+            pred = torch.cat(pred, 0).view(k, len(crop), 2)
+            pred_prob = softmax(pred.data.cpu().numpy(), axis=2).mean(axis=1)
 
         return pred_prob
 
+    def default_chunk_size(self):
+        # ~1.5GB of Tri2DNet activations per 112^3 crop
+        return default_batch_size(
+            self.device, item_mb=1536, max_batch_size=64, cpu_batch_size=8)
+
     def grad_cam_visual(self, volumes):
+        import cv2
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.axes_grid1 import ImageGrid
+        from scipy.ndimage import gaussian_filter
+        from skimage.transform import resize as imresize
+        from visualization import GradCam
+
         if isinstance(volumes, np.ndarray):
             volumes = torch.from_numpy(volumes)
         self.encoder.eval()
@@ -291,10 +377,10 @@ class Model:
 
         volumes = volumes.unsqueeze(0)
         grad_cam.model.zero_grad()
-        pred = grad_cam(volumes.cuda())
+        pred = grad_cam(volumes.to(self.device))
         one_hot = torch.zeros(pred.size())
         one_hot[:, 1] = 1
-        one_hot = one_hot.cuda().float()
+        one_hot = one_hot.to(self.device).float()
         y = (one_hot * pred).sum()
         y.backward()
 
@@ -340,14 +426,40 @@ class Model:
     def load_model(self, restore_iter=None):
         if restore_iter is None:
             restore_iter = self.restore_iter
-        self.encoder.load_state_dict(torch.load(osp.join(
+        self.load_encoder_state(torch.load(osp.join(
             'checkpoint',
-            '{}-{:0>5}-encoder.ptm'.format(self.save_name, restore_iter))))
+            '{}-{:0>5}-encoder.ptm'.format(self.save_name, restore_iter)),
+            map_location=self.device))
         opt_path = osp.join(
             'checkpoint',
             '{}-{:0>5}-optimizer.ptm'.format(self.save_name, restore_iter))
-        if osp.isfile(opt_path):
-            self.optimizer.load_state_dict(torch.load(opt_path))
+        if self.optimizer is not None and osp.isfile(opt_path):
+            self.optimizer.load_state_dict(torch.load(opt_path, map_location=self.device))
+
+    def scripted_path(self, export_dir, restore_iter=None):
+        if restore_iter is None:
+            restore_iter = self.restore_iter
+        return osp.join(
+            export_dir,
+            '{}-{:0>5}-encoder-{}.torchscript.pt'.format(self.save_name, restore_iter, self.device.type))
+
+    def load_scripted(self, export_dir, restore_iter=None):
+        # Tri2DNet traced and frozen by export_models.py, scoring in place of
+        # the encoder, which grad_cam_visual still uses
+        if self.precision != 'fp32':
+            raise ValueError('The exported Tri2DNet runs in fp32, use --precision fp32 with it.')
+        if self.tta != 'exact':
+            raise ValueError('The exported Tri2DNet runs the exact TTA only.')
+        self.scripted_encoder = load_scripted(self.scripted_path(export_dir, restore_iter), self.device)
 
     def load_pretrain(self):
-        self.encoder.load_state_dict(torch.load(self.prt_path), False)
\ No newline at end of file
+        self.load_encoder_state(torch.load(self.prt_path, map_location=self.device), False)
+
+    def load_encoder_state(self, state_dict, strict=True):
+        # Checkpoints are saved from the nn.DataParallel wrapper, so their
+        # keys carry a "module." prefix that a bare Tri2DNet does not expect
+        if not isinstance(self.encoder, nn.DataParallel):
+            state_dict = {
+                k[len('module.'):] if k.startswith('module.') else k: v
+                for k, v in state_dict.items()}
+        self.encoder.load_state_dict(state_dict, strict)
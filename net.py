@@ -7,11 +7,25 @@ import torch.nn as nn
 import torchvision.models as models
 
 
+def vgg11_bn_features():
+    # The convolutions of models.vgg11_bn(), initialized the same way, without
+    # its 120M parameter classifier that AttBranch throws away
+    features = models.vgg.make_layers(models.vgg.cfgs['A'], batch_norm=True)
+    for m in features.modules():
+        if isinstance(m, nn.Conv2d):
+            nn.init.kaiming_normal_(m.weight, mode='fan_out', nonlinearity='relu')
+            if m.bias is not None:
+                nn.init.constant_(m.bias, 0)
+        elif isinstance(m, nn.BatchNorm2d):
+            nn.init.constant_(m.weight, 1)
+            nn.init.constant_(m.bias, 0)
+    return features
+
+
 class AttBranch(nn.Module):
     def __init__(self):
         super(AttBranch, self).__init__()
-        _net = models.vgg11_bn()
-        _net_list = list(_net.children())[0]
+        _net_list = vgg11_bn_features()
         self.backbone2d = nn.Sequential(
             nn.Conv2d(1, 64, kernel_size=3, dilation=2, padding=2, bias=False),
             *_net_list[1:-14],
@@ -44,13 +58,26 @@ class Branch(nn.Module):
             self.dout = nn.Dropout()
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x, chunk=None):
+        # 2D features of every slice, chunk slices at a time:
+        # n, d, c, h, w -> n, d, 256, h / 8, w / 8
         n, d, c, h, w = x.size()
         x_org = x.view(n * d, c, 1, h, w).contiguous()
+        if chunk is None:
+            x = self.slice_features(x_org)
+        else:
+            x = torch.cat([self.slice_features(x_org[i:i + chunk]) for i in range(0, n * d, chunk)])
+        _, c, h, w = x.size()
+        return x.view(n, d, c, h, w)
+
+    def slice_features(self, x_org):
         x = self.backbone2d(x_org[:, 0, :, :, :])
         att = self.att_branch(x_org[:, 1, :, :, :])
-        x = x * (att + 1)
-        _, c, h, w = x.size()
-        x = x.view(n, d, c, h, w)
+        return x * (att + 1)
+
+    def head(self, x):
         # -> n, c, d, h, w
         x = x.permute(0, 2, 1, 3, 4).contiguous()
         aux_feature = x.max(dim=2)[0]
@@ -83,17 +110,57 @@ class Tri2DNet(nn.Module):
                 nn.init.constant_(m.bias, 0)
 
     def forward(self, x):
-        n, c, d, h, w = x.size()
+        x_sagittal, x_coronal, x_axial = self.views(x)
+        del x
+        return self.fuse(
+            self.branch_sagittal(x_sagittal),
+            self.branch_coronal(x_coronal),
+            self.branch_axial(x_axial))
+
+    def views(self, x):
         # -> n, w, c, h, d
         x_sagittal = x.permute(0, 4, 1, 3, 2).contiguous()
         # -> n, h, c, d, w
         x_coronal = x.permute(0, 3, 1, 2, 4).contiguous()
         # -> n, d, c, h, w
         x_axial = x.permute(0, 2, 1, 3, 4).contiguous()
-        del x
-        aux_pred_sagittal, aux_feature_sagittal = self.branch_sagittal(x_sagittal)
-        aux_pred_coronal, aux_feature_coronal = self.branch_coronal(x_coronal)
-        aux_pred_axial, aux_feature_axial = self.branch_axial(x_axial)
+        return x_sagittal, x_coronal, x_axial
+
+    def forward_crops(self, x, offsets, size, chunk=None):
+        """forward of the crops x[:, :, d:d + size, h:h + size, w:w + size]
+        for every (d, h, w) in offsets, volume by volume.
+
+        The 2D trunks run once on every slice of x, chunk slices at a time,
+        and each crop slices its features out of them, instead of running
+        them again on the slices of every overlapping crop. The offsets must
+        be multiples of the stride of the trunks, 8. The crop features are
+        exact along the slice axis, but in each slice they only approximate
+        those of forward within the receptive field of a crop edge that lies
+        inside x: there the trunk sees the neighbouring voxels where forward
+        sees zero padding.
+        """
+        outputs = []
+        branches = (self.branch_sagittal, self.branch_coronal, self.branch_axial)
+        # (slice, row, column) axes of the views among the (d, h, w) offsets
+        view_axes = ((2, 1, 0), (1, 0, 2), (0, 1, 2))
+        for branch, view, axes in zip(branches, self.views(x), view_axes):
+            features = branch.trunk(view, chunk)
+            stride = view.size(-1) // features.size(-1)
+            crops = []
+            for offset in offsets:
+                s, r, c = (offset[axis] for axis in axes)
+                if r % stride or c % stride:
+                    raise ValueError('Crop offset {} is not a multiple of {}'.format(offset, stride))
+                crops.append(features[:, s:s + size, :, r // stride:(r + size) // stride,
+                                      c // stride:(c + size) // stride])
+            # n x len(offsets) crops, in the order of the volumes then offsets
+            outputs.append(branch.head(torch.stack(crops, 1).flatten(0, 1)))
+        return self.fuse(*outputs)
+
+    def fuse(self, sagittal, coronal, axial):
+        aux_pred_sagittal, aux_feature_sagittal = sagittal
+        aux_pred_coronal, aux_feature_coronal = coronal
+        aux_pred_axial, aux_feature_axial = axial
         feature = torch.cat([aux_feature_sagittal, aux_feature_coronal, aux_feature_axial], dim=1)
         feature = feature / feature.norm(dim=1, keepdim=True)
         pred = self.fc_fuse(feature)
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+
+# Staged execution of a batch scoring run. A pool of worker processes reads,
+# resizes and crops the CT volumes, the main process owns the models and runs
+# heart detection and Tri2DNet, and a writer thread saves the outputs.
+
+import csv
+import io
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import SimpleITK as sitk
+
+from image import Image
+from profiling import merge_stats, stage, timed
+
+logger = logging.getLogger('cvd-risk-score')
+
+CSV_HEADERS = ['input_path', 'cvd_risk_score', 'first_heart_slice', 'last_heart_slice', 'status', 'processing_time_seconds',
+               'preprocess_profile', 'tta', 'precision']
+INDEX_HEADERS = ['input_path', 'size', 'mtime_ns']
+# Value of the columns added to CSV_HEADERS since its first version, in the
+# rows of the CSVs written before them
+COLUMN_DEFAULTS = {'preprocess_profile': 'accurate', 'tta': 'exact', 'precision': 'fp32'}
+EVENTS_HEADERS = ['input_path', 'stage', 'start', 'end']
+
+
+def init_csv(csv_path, headers=CSV_HEADERS):
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(headers)
+
+
+def read_csv(csv_path):
+    # header and rows of a CSV
+    with open(csv_path, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        return next(reader, []), list(reader)
+
+
+def upgrade_rows(csv_path, header, rows):
+    """Rows of a results CSV with the given header, completed to the columns
+    of CSV_HEADERS. Raises ValueError if they cannot be."""
+    added = CSV_HEADERS[len(header):]
+    if header != CSV_HEADERS[:len(header)] or any(name not in COLUMN_DEFAULTS for name in added):
+        raise ValueError(
+            f'{csv_path} has the columns {header}, which this version cannot extend to {CSV_HEADERS}. '
+            f'Score into another --output-dir.')
+    return [row + [COLUMN_DEFAULTS[name] for name in added] for row in rows]
+
+
+def upgrade_csv(csv_path):
+    """Rewrite a results CSV of an earlier version with the columns of
+    CSV_HEADERS, so that --resume appends rows under a matching header.
+    Returns whether it was rewritten."""
+    header, rows = read_csv(csv_path)
+    if header == CSV_HEADERS:
+        return False
+    rows = upgrade_rows(csv_path, header, rows)
+    tmp_path = csv_path + '.tmp'
+    init_csv(tmp_path)
+    with open(tmp_path, 'a', newline='') as csvfile:
+        csv.writer(csvfile).writerows(rows)
+    os.replace(tmp_path, csv_path)
+    return True
+
+
+def shard_suffix(shard_index=0, num_shards=1):
+    # A single shard keeps the historical file names
+    if num_shards == 1:
+        return ''
+    return f'.shard-{shard_index:03d}-of-{num_shards:03d}'
+
+
+def result_paths(output_dir, shard_index=0, num_shards=1):
+    """CSV and log file of one shard of a run."""
+    suffix = shard_suffix(shard_index, num_shards)
+    return (os.path.join(output_dir, f'cvd_results{suffix}.csv'),
+            os.path.join(output_dir, f'cvd-risk-score{suffix}.log'))
+
+
+def read_input_list(input_list, shard_index=0, num_shards=1):
+    # Round-robin partitioning: line i belongs to shard i % num_shards
+    with open(input_list, 'r') as file_paths:
+        # Remove leading/trailing whitespaces and newline characters
+        input_paths = [line.strip() for line in file_paths]
+    return input_paths[shard_index::num_shards]
+
+
+def merge_results(input_list, output_dir, num_shards):
+    """Merge the shard CSVs and indexes of a run into cvd_results.csv.
+
+    Rows follow the order of the input list; for a scan that was retried
+    with --resume the last row wins. Shards written by an earlier version
+    get the columns added since (upgrade_rows). Returns the input paths
+    without a row.
+    """
+    rows, index_rows = {}, {}
+    for shard_index in range(num_shards):
+        csv_path = result_paths(output_dir, shard_index, num_shards)[0]
+        for path, merged in ((csv_path, rows), (index_path(csv_path), index_rows)):
+            if not os.path.exists(path):
+                continue
+            header, shard_rows = read_csv(path)
+            if path == csv_path and header != CSV_HEADERS:
+                # a shard written by an earlier version
+                shard_rows = upgrade_rows(path, header, shard_rows)
+            for row in shard_rows:
+                merged[row[0]] = row
+    profiles = {}
+    for shard_index in range(num_shards):
+        path = profile_path(result_paths(output_dir, shard_index, num_shards)[0])
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    profiles[record['input_path']] = line
+    csv_path = result_paths(output_dir)[0]
+    init_csv(csv_path)
+    init_csv(index_path(csv_path), INDEX_HEADERS)
+    if profiles:
+        open(profile_path(csv_path), 'w').close()
+    missing = []
+    written = set()
+    for input_path in read_input_list(input_list):
+        if not input_path or input_path in written:
+            continue
+        if input_path not in rows:
+            missing.append(input_path)
+            continue
+        written.add(input_path)
+        append_to_csv(csv_path, rows[input_path])
+        if input_path in index_rows:
+            append_to_csv(index_path(csv_path), index_rows[input_path])
+        if input_path in profiles:
+            with open(profile_path(csv_path), 'a') as f:
+                f.write(profiles[input_path])
+    return missing
+
+
+def index_path(csv_path):
+    # Sidecar listing the scans with a success row in csv_path
+    return os.path.splitext(csv_path)[0] + '_index.csv'
+
+
+def profile_path(csv_path):
+    # Sidecar with the --profile record of every scan in csv_path
+    return os.path.splitext(csv_path)[0] + '_profile.jsonl'
+
+
+def events_path(csv_path):
+    # Scan and stage spans of every scan in csv_path, with --sample-resources
+    return os.path.splitext(csv_path)[0] + '_events.csv'
+
+
+def resources_path(csv_path):
+    # Resource samples of the run writing csv_path, with --sample-resources
+    return os.path.splitext(csv_path)[0] + '_resources.csv'
+
+
+def scan_signature(input_path):
+    stat = os.stat(input_path)
+    return [input_path, str(stat.st_size), str(stat.st_mtime_ns)]
+
+
+def init_index(csv_path, completed=()):
+    # completed carries over the scans of a CSV written without an index
+    init_csv(index_path(csv_path), INDEX_HEADERS)
+    for input_path in sorted(completed):
+        if os.path.exists(input_path):
+            append_to_csv(index_path(csv_path), scan_signature(input_path))
+
+
+def completed_scans(csv_path):
+    """Inputs already scored in an earlier run, for --resume.
+
+    Entries of the sidecar index only count while the file size and mtime
+    still match; without an index the success rows of the CSV are used.
+    """
+    completed = set()
+    if os.path.exists(index_path(csv_path)):
+        with open(index_path(csv_path), newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                try:
+                    signature = scan_signature(row['input_path'])
+                except OSError:
+                    continue
+                if signature == [row[h] for h in INDEX_HEADERS]:
+                    completed.add(row['input_path'])
+    elif os.path.exists(csv_path):
+        with open(csv_path, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                if row.get('status') == 'success':
+                    completed.add(row['input_path'])
+    return completed
+
+
+def append_to_csv(csv_path, data_row):
+    """Append a single row of data to the CSV file."""
+    with open(csv_path, 'a', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(data_row)
+
+
+def prepare_scan(input_path, output_dir, save_maps):
+    """Output paths of one input scan, or None if it is not a BIDS path."""
+    # Define regular expressions to match 'sub' and 'ses' parts
+    sub_pattern = r'sub-\d+'
+    ses_pattern = r'ses-[A-Za-z0-9]+'
+    # Extract 'sub' and 'ses' parts from the file path
+    sub_match = re.search(sub_pattern, input_path)
+    ses_match = re.search(ses_pattern, input_path)
+    if not sub_match or not ses_match:
+        logger.error(f'BIDS format not found in {input_path}')
+        return None
+    sub_part = sub_match.group(0)
+    ses_part = ses_match.group(0)
+    # output files must be stored respecting BIDS structure:
+    # output_dir/sub-XXXXXX/ses-XX/ct
+    output_path = os.path.join(output_dir, sub_part, ses_part, 'ct')
+    file_name = os.path.basename(input_path)
+    scan = {
+        'input_path': input_path,
+        'output_path': output_path,
+        'score_file_path': os.path.join(
+            output_path, file_name.replace('ct.nii.gz', 'desc-cvdr.txt')),
+        'heart_slices_file_path': os.path.join(
+            output_path, file_name.replace('ct.nii.gz', 'desc-heartslices.txt')),
+    }
+    if save_maps:
+        image_identifier = file_name.replace('_ct.nii.gz', '')
+        scan['gradmap_file_path'] = os.path.join(
+            output_path, file_name.replace('ct.nii.gz', 'desc-gradmap.png'))
+        scan['heartdetect_file_path'] = os.path.join(
+            output_path, f'{image_identifier}_desc-heartdetect.png')
+    return scan
+
+
+# Worker stages, run in the process pool
+
+def init_worker(num_threads):
+    # share the cores between the workers instead of oversubscribing them
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def load_scan(input_path, cache=None, lookup=True, preprocess=None, profile=False):
+    # Returns (cache key, Image, stats), or (cache key, crop result, stats) on
+    # a cache hit. stats holds the stage timings and spans and, with profile,
+    # the peak RSS.
+    key = None
+    stats = {'seconds': {}}
+    with stage(stats, 'load', memory=profile):
+        if cache is not None:
+            with timed(stats['seconds'], 'cache_lookup'):
+                try:
+                    key = cache.key(input_path)
+                except OSError:
+                    # unreadable input, let SimpleITK report it below
+                    pass
+                cached = cache.get(key) if key is not None and lookup else None
+            if cached is not None:
+                # stats are merged into the scan once, not again with the crop result
+                return key, cached_crop(cached), stats
+        image = Image()
+        preprocess = preprocess or {}
+        image.load(input_path, preprocess.get('detector_dtype', 'float32'),
+                   preprocess.get('profile', 'accurate'))
+    stats['seconds'].update(image.timings)
+    return key, image, stats
+
+
+def crop_result(image, stats=None):
+    result = {
+        'heart_detected': image.heart_detected,
+        'first_heart_slice': image.first_slice,
+        'last_heart_slice': image.last_slice,
+        'network_input': None,
+        'stats': stats if stats is not None else {'seconds': {}},
+    }
+    if image.heart_detected:
+        result['network_input'] = image.to_network_input()
+    result['stats']['seconds'].update(image.timings)
+    return result
+
+
+def crop_scan(image, cache=None, key=None, preprocess=None, profile=False):
+    preprocess = preprocess or {}
+    stats = {'seconds': {}}
+    with stage(stats, 'crop', memory=profile):
+        image.crop_heart(preprocess.get('crop_first', False),
+                         preprocess.get('profile', 'accurate'))
+        if key is not None:
+            with timed(stats['seconds'], 'cache_store'):
+                if image.heart_detected:
+                    cache.put(key, True, image.detected_npy, image.bbox, image.bbox_selected,
+                              image.first_slice, image.last_slice)
+                else:
+                    cache.put(key, False)
+        return crop_result(image, stats)
+
+
+def cached_crop(cached, stats=None):
+    image = Image()
+    image.heart_detected = cached['heart_detected']
+    if image.heart_detected:
+        image.detected_npy = cached['detected_npy']
+        image.bbox = cached['bbox']
+        image.bbox_selected = cached['bbox_selected']
+        image.first_slice = cached['first_heart_slice']
+        image.last_slice = cached['last_heart_slice']
+    return crop_result(image, stats)
+
+
+def crop_request(image):
+    # Only what crop_heart needs is sent to the worker
+    request = Image()
+    request.org_ct_img = image.org_ct_img
+    request.min_value = image.min_value
+    request.bbox = image.bbox
+    request.bbox_selected = image.bbox_selected
+    request.heart_detected = image.heart_detected
+    return request
+
+
+class InlineExecutor:
+    """Runs submitted work immediately, for --workers 0."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class OutputWriter:
+    """Writes scan outputs on a background thread, at most maxsize jobs queued."""
+
+    def __init__(self, maxsize):
+        self.jobs = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='output-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            fn, args = job
+            if self.error is not None:
+                continue
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, fn, *args):
+        self._check()
+        self.jobs.put((fn, args))
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+        self._check()
+
+
+# Writer stage
+
+def write_profile(scan, status, elapsed_time, csv_file_path):
+    record = {
+        'input_path': scan['input_path'],
+        'status': status,
+        'preprocess_profile': scan['preprocess_profile'],
+        'tta': scan['tta'],
+        'precision': scan['precision'],
+        'cache_hit': scan.get('cache_hit', False),
+        'inference_batch_size': scan.get('inference_batch_size'),
+        'total_seconds': elapsed_time,
+    }
+    record.update(scan['stats'])
+    with open(profile_path(csv_file_path), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def write_events(scan, csv_file_path):
+    # the scan and its stage spans, to be overlaid on the resource samples
+    rows = [[scan['input_path'], 'scan', scan['start_time'], time.time()]]
+    for name, (start, end) in scan['stats']['spans'].items():
+        rows.append([scan['input_path'], name, start, end])
+    with open(events_path(csv_file_path), 'a', newline='') as csvfile:
+        csv.writer(csvfile).writerows(rows)
+
+
+def write_failure(scan, csv_file_path, profile=False, events=False):
+    with stage(scan['stats'], 'write'), timed(scan['stats']['seconds'], 'write'):
+        os.makedirs(scan['output_path'], exist_ok=True)
+        with open(scan['score_file_path'], 'w') as output_file:
+            output_file.write('FAILED HEART DETECTION')
+    elapsed_time = time.time() - scan['start_time']
+    row = [scan['input_path'], "N/A", "N/A", "N/A", "fail", elapsed_time, scan['preprocess_profile'],
+           scan['tta'], scan['precision']]
+    append_to_csv(csv_file_path, row)
+    if profile:
+        write_profile(scan, 'fail', elapsed_time, csv_file_path)
+    if events:
+        write_events(scan, csv_file_path)
+
+
+def write_success(scan, cvd_risk_score, maps, csv_file_path, profile=False, events=False):
+    input_path = scan['input_path']
+    score_file_path = scan['score_file_path']
+    first_heart_slice = scan['first_heart_slice']
+    last_heart_slice = scan['last_heart_slice']
+    with stage(scan['stats'], 'write'), timed(scan['stats']['seconds'], 'write'):
+        os.makedirs(scan['output_path'], exist_ok=True)
+        for file_path, png in maps:
+            with open(file_path, 'wb') as output_file:
+                output_file.write(png)
+        with open(score_file_path, 'w') as output_file:
+            output_file.write(f'Estimated CVD Risk: {cvd_risk_score}\n')
+        with open(scan['heart_slices_file_path'], 'w') as output_file:
+            output_file.write(f'First heart slice: {first_heart_slice}\n')
+            output_file.write(f'Last heart slice: {last_heart_slice}\n')
+
+    elapsed_time = time.time() - scan['start_time']
+    status = 'success'
+    row = [input_path, cvd_risk_score, first_heart_slice, last_heart_slice, status, elapsed_time,
+           scan['preprocess_profile'], scan['tta'], scan['precision']]
+    append_to_csv(csv_file_path, row)
+    append_to_csv(index_path(csv_file_path), scan_signature(input_path))
+    if profile:
+        write_profile(scan, status, elapsed_time, csv_file_path)
+    if events:
+        write_events(scan, csv_file_path)
+
+    logger.info(f'Processed {input_path} in {elapsed_time:.2f} seconds. CVD Risk saved to {score_file_path}.')
+
+
+# Inference stage, run in the main process
+
+def render_maps(scan, model):
+    # pyplot is not thread safe, so the figures are drawn here and only the
+    # encoded PNGs are handed to the writer. It is only loaded for the maps.
+    import matplotlib.pyplot as plt
+
+    seconds = scan['stats']['seconds']
+    heartdetect_png = io.BytesIO()
+    with timed(seconds, 'heartdetect_map'):
+        scan['image'].detect_visual(fileobj=heartdetect_png)
+    gradmap_png = io.BytesIO()
+    with timed(seconds, 'gradcam'):
+        model.grad_cam_visual(scan['network_input'])
+        plt.savefig(gradmap_png, format='png')
+    plt.close('all')
+    return [
+        (scan['heartdetect_file_path'], heartdetect_png.getvalue()),
+        (scan['gradmap_file_path'], gradmap_png.getvalue()),
+    ]
+
+
+def prefetch(scans, submit, depth):
+    # Yield (scan, future) in input order while up to depth scans run ahead
+    in_flight = deque()
+    for scan in scans:
+        in_flight.append((scan, submit(scan)))
+        if len(in_flight) > depth:
+            yield in_flight.popleft()
+    while in_flight:
+        yield in_flight.popleft()
+
+
+def locate(loaded, heart_detector, save_maps, profile=False, device=None):
+    for scan, future in loaded:
+        try:
+            scan['cache_key'], image, stats = future.result()
+            merge_stats(scan['stats'], stats)
+            # the scan starts with its load, not when it was queued
+            scan['start_time'] = stats['spans']['load'][0]
+        except RuntimeError as e:
+            logger.error(f'Error processing {scan["input_path"]}: {e}')
+            scan['image'] = None
+            yield scan
+            continue
+        if not isinstance(image, Image):
+            # cache hit, the crop result is already there
+            scan['cache_hit'] = True
+            scan['image'] = None
+            scan['cached'] = image
+            yield scan
+            continue
+        try:
+            with stage(scan['stats'], 'detection', device, profile):
+                image.locate_heart(heart_detector)
+            scan['stats']['seconds']['detection'] = image.timings['detection']
+        except RuntimeError as e:
+            logger.error(f'Error processing {scan["input_path"]}: {e}')
+            image = None
+        if image is not None and not save_maps:
+            # the normalized volume is only needed again to draw the maps
+            image.org_npy = None
+            image.visual_bbox = None
+        scan['image'] = image
+        yield scan
+
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def run_pipeline(scans, model, heart_detector, csv_file_path, save_maps,
+                 workers=0, queue_depth=4, write_queue=8, scan_batch_size=1, cache=None,
+                 preprocess=None, profile=False, events=False):
+    """Score scans in input order and write exactly one result per scan.
+
+    With workers > 0, reading/resizing and cropping run in that many
+    processes, up to queue_depth scans ahead of the models. With a cache,
+    scans preprocessed by an earlier run go straight to Tri2DNet; the maps
+    need the full volume, so save_maps only fills the cache. preprocess
+    holds the detector_dtype, crop_first and profile options of
+    Image.load/crop_heart. With profile, the stage timings and memory peaks
+    of every scan are appended to profile_path(csv_file_path), and with
+    events its start/end and stage spans to events_path(csv_file_path).
+    """
+    device = getattr(model, 'device', None)
+    # recorded with every scan, like the preprocessing profile
+    tta = getattr(model, 'tta', 'exact')
+    precision = getattr(model, 'precision', 'fp32')
+    if workers > 0:
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        executor = ProcessPoolExecutor(
+            workers, mp_context=mp.get_context('spawn'),
+            initializer=init_worker, initargs=(max(1, cpu_count // workers),))
+    else:
+        executor = InlineExecutor()
+        # the inline executor loads and crops on submit, so running ahead
+        # would only hold more volumes in memory: one scan at a time
+        queue_depth = 0
+    writer = OutputWriter(write_queue)
+
+    def submit_load(scan):
+        logger.info(f'input path: {scan["input_path"]}')
+        scan['start_time'] = time.time()
+        scan['preprocess_profile'] = (preprocess or {}).get('profile', 'accurate')
+        scan['tta'] = tta
+        scan['precision'] = precision
+        scan['stats'] = {'seconds': {}}
+        return executor.submit(
+            load_scan, scan['input_path'], cache, not save_maps, preprocess, profile)
+
+    def submit_crop(scan):
+        if 'cached' in scan:
+            return completed_future(scan.pop('cached'))
+        if scan['image'] is None:
+            return None
+        if not scan['image'].heart_detected:
+            if scan['cache_key'] is not None:
+                writer.submit(cache.put, scan['cache_key'], False)
+            return None
+        return executor.submit(
+            crop_scan, crop_request(scan['image']), cache, scan['cache_key'], preprocess, profile)
+
+    def score(pending):
+        to_score = [scan for scan in pending if scan['network_input'] is not None]
+        if to_score:
+            batch_stats = {'seconds': {}}
+            with stage(batch_stats, 'inference', device, profile):
+                with timed(batch_stats['seconds'], 'inference'):
+                    cvd_risk_scores = model.aug_transform_batch(
+                        [scan['network_input'] for scan in to_score])[:, 1]
+            # the batch time is shared evenly between its scans
+            batch_stats['seconds']['inference'] /= len(to_score)
+            for scan, cvd_risk_score in zip(to_score, cvd_risk_scores):
+                scan['cvd_risk_score'] = cvd_risk_score
+                merge_stats(scan['stats'], batch_stats)
+                scan['inference_batch_size'] = len(to_score)
+        for scan in pending:
+            if scan['network_input'] is None:
+                writer.submit(write_failure, scan, csv_file_path, profile, events)
+                continue
+            if save_maps:
+                with stage(scan['stats'], 'maps', device, profile):
+                    maps = render_maps(scan, model)
+            else:
+                maps = []
+            scan['image'] = None
+            scan['network_input'] = None
+            writer.submit(write_success, scan, scan['cvd_risk_score'], maps, csv_file_path, profile,
+                          events)
+        del pending[:]
+
+    try:
+        loaded = prefetch(scans, submit_load, queue_depth)
+        located = locate(loaded, heart_detector, save_maps, profile, device)
+        cropped = prefetch(located, submit_crop, queue_depth)
+        pending = []
+        num_to_score = 0
+        for scan, future in cropped:
+            scan['network_input'] = None
+            if future is not None:
+                try:
+                    result = future.result()
+                    merge_stats(scan['stats'], result.pop('stats'))
+                    scan.update(result)
+                except RuntimeError as e:
+                    logger.error(f'Error processing {scan["input_path"]}: {e}')
+                    scan['heart_detected'] = False
+                if not scan['heart_detected']:
+                    logger.error(f'Heart detection failed for {scan["input_path"]}. Skipping to the next image.')
+            elif scan['image'] is not None:
+                logger.error(f'Heart detection failed for {scan["input_path"]}. Skipping to the next image.')
+            if not save_maps:
+                scan['image'] = None
+            pending.append(scan)
+            if scan['network_input'] is not None:
+                num_to_score += 1
+            if num_to_score >= scan_batch_size:
+                score(pending)
+                num_to_score = 0
+        score(pending)
+    finally:
+        executor.shutdown()
+        writer.close()
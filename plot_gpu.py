@@ -3,52 +3,120 @@ import datetime
 import matplotlib.pyplot as plt
 import argparse
 import os
+import sys
 
 # Set up argument parser
 parser = argparse.ArgumentParser(description="Parse GPU usage report and plot data.")
-parser.add_argument('filename', type=str, help="Input CSV file containing GPU usage data")
+parser.add_argument('filename', type=str,
+                    help="Input CSV file containing GPU usage data: an nvidia-smi CSV, or the "
+                         "cvd_results_resources.csv written by cvdrisk_BIDS.py --sample-resources")
+parser.add_argument('--events', type=str, default=None,
+                    help="CSV of scan and stage spans to overlay. Default: the cvd_results_events.csv next to "
+                         "a cvd_results_resources.csv")
+parser.add_argument('--no-stages', action='store_true',
+                    help="Only mark the scan starts and ends, not the stage spans")
 args = parser.parse_args()
 base_filename = os.path.splitext(args.filename)[0]
 
+STAGE_COLORS = {
+    'load': 'tab:green',
+    'detection': 'tab:orange',
+    'crop': 'tab:olive',
+    'inference': 'tab:purple',
+    'maps': 'tab:brown',
+    'write': 'tab:gray',
+}
+
 timestamps = []
-utilizations = []
-memory_used = []
+series = {}
 
 with open(args.filename, 'r') as file:
     reader = csv.reader(file)
-    next(reader)  # Skip the header line
+    header = next(reader)
+    # the sampler of cvdrisk_BIDS.py names its columns, nvidia-smi has
+    # timestamp, utilization.gpu [%], memory.used [MiB]
+    sampler = len(header) > 1 and header[1] == 'elapsed_seconds'
+    if sampler:
+        columns = {name: header.index(name) for name in
+                   ('cpu_percent', 'rss_mb', 'gpu_utilization', 'gpu_memory_mb')}
+    else:
+        columns = {'gpu_utilization': 1, 'gpu_memory_mb': 2}  # Column index 2 corresponds to memory.used
+    for name in columns:
+        series[name] = []
     for row in reader:
         timestamp_str = row[0]
-        utilization = float(row[1])
-        memory = float(row[2])  # Column index 2 corresponds to memory.used
 
         # Convert timestamp string to datetime object
-        timestamp = datetime.datetime.strptime(timestamp_str, "%Y/%m/%d %H:%M:%S.%f")
+        timestamp = datetime.datetime.strptime(timestamp_str.strip(), "%Y/%m/%d %H:%M:%S.%f")
         timestamps.append(timestamp)
-        utilizations.append(utilization)
-        memory_used.append(memory)
+        for name, column in columns.items():
+            # the device columns are empty on CPU-only runs
+            series[name].append(float(row[column]) if row[column].strip() else None)
+
+if not timestamps:
+    sys.exit(f"{args.filename} has no samples to plot")
 
 # Calculate elapsed time from the starting timestamp
 elapsed_time = [(timestamp - timestamps[0]).total_seconds() for timestamp in timestamps]
 
-# Plot GPU utilization and memory usage on the same plot
-fig, ax1 = plt.subplots()
+# One panel per pair of counters: CPU utilization and RSS, GPU utilization and memory
+panels = []
+if 'cpu_percent' in series:
+    panels.append((('cpu_percent', 'CPU Utilization (% of a core)'), ('rss_mb', 'RSS (MiB)')))
+if any(value is not None for value in series['gpu_utilization'] + series['gpu_memory_mb']):
+    panels.append((('gpu_utilization', 'GPU Utilization (%)'), ('gpu_memory_mb', 'GPU Memory Used (MiB)')))
+
+if not panels:
+    sys.exit(f"{args.filename} has no CPU or GPU values to plot: the GPU columns are empty and there "
+             "are no CPU columns")
+
+fig, axes = plt.subplots(len(panels), 1, sharex=True, squeeze=False,
+                         figsize=(max(6.4, min(30, len(elapsed_time) / 20)), 4 * len(panels)))
+axes = axes[:, 0]
+
+for ax1, ((left, left_label), (right, right_label)) in zip(axes, panels):
+    # Plot the utilization percentage
+    color = 'tab:blue'
+    ax1.set_ylabel(left_label, color=color)
+    ax1.plot(elapsed_time, series[left], color=color, marker='o')
+    ax1.tick_params(axis='y', labelcolor=color)
 
-# Plot GPU utilization percentage
-color = 'tab:blue'
-ax1.set_xlabel('Time (s)')
-ax1.set_ylabel('GPU Utilization (%)', color=color)
-ax1.plot(elapsed_time, utilizations, color=color, marker='o')
-ax1.tick_params(axis='y', labelcolor=color)
+    # Create a second y-axis for the memory usage
+    ax2 = ax1.twinx()
+    color = 'tab:red'
+    ax2.set_ylabel(right_label, color=color)
+    ax2.plot(elapsed_time, series[right], color=color, marker='o')
+    ax2.tick_params(axis='y', labelcolor=color)
+axes[-1].set_xlabel('Time (s)')
 
-# Create a second y-axis for GPU memory usage
-ax2 = ax1.twinx()
+# Overlay the scan boundaries and stage spans written with --sample-resources
+events_filename = args.events
+if events_filename is None and base_filename.endswith('_resources'):
+    events_filename = base_filename[:-len('_resources')] + '_events.csv'
+if events_filename is not None and os.path.exists(events_filename):
+    def to_elapsed(seconds):
+        return (datetime.datetime.fromtimestamp(float(seconds)) - timestamps[0]).total_seconds()
 
-# Plot GPU memory usage 
-color = 'tab:red'
-ax2.set_ylabel('GPU Memory Used (MiB)', color=color)
-ax2.plot(elapsed_time, memory_used, color=color, marker='o')
-ax2.tick_params(axis='y', labelcolor=color)
+    stages_seen = set()
+    with open(events_filename, 'r') as file:
+        reader = csv.DictReader(file)
+        for event in reader:
+            start, end = to_elapsed(event['start']), to_elapsed(event['end'])
+            for ax in axes:
+                if event['stage'] == 'scan':
+                    ax.axvline(start, color='tab:green', linestyle='--', linewidth=0.8)
+                    ax.axvline(end, color='black', linestyle=':', linewidth=0.8)
+                elif not args.no_stages:
+                    ax.axvspan(start, end, color=STAGE_COLORS.get(event['stage'], 'tab:cyan'),
+                               alpha=0.2, linewidth=0)
+            stages_seen.add(event['stage'])
+    handles = [plt.Line2D([], [], color='tab:green', linestyle='--', label='scan start'),
+               plt.Line2D([], [], color='black', linestyle=':', label='scan end')]
+    if not args.no_stages:
+        handles += [plt.Rectangle((0, 0), 1, 1, color=STAGE_COLORS.get(stage, 'tab:cyan'), alpha=0.2, label=stage)
+                    for stage in list(STAGE_COLORS) + sorted(stages_seen - set(STAGE_COLORS) - {'scan'})
+                    if stage in stages_seen]
+    axes[0].legend(handles=handles, loc='upper left', bbox_to_anchor=(1.1, 1), fontsize='small')
 
 # Adjust plot margins
 fig.tight_layout()
@@ -58,4 +126,4 @@ output_filename = f"{base_filename}_plot.png"
 plt.savefig(output_filename, bbox_inches='tight')
 
 # Show the plot
-plt.show()
\ No newline at end of file
+plt.show()
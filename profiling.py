@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+# Per-stage timings and memory peaks of a scan, written with --profile, and
+# the resource sampler of --sample-resources
+
+import csv
+import os
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+
+@contextmanager
+def timed(timings, name):
+    # Add the wall time of the block to timings[name]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def reset_peak_rss():
+    # Linux only: restart VmHWM from the current resident set size
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # lifetime peak, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_device_memory(device):
+    if device is not None and device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_device_memory_mb(device):
+    if device is None or device.type != 'cuda':
+        return None
+    return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+
+
+@contextmanager
+def stage(stats, name, device=None, memory=False):
+    """Record the wall clock span of a pipeline stage in stats['spans'][name].
+
+    With memory, also record the peak RSS (and device memory) reached inside
+    the block. That is the peak of the whole process, so stages overlapping
+    in other threads count too.
+    """
+    if memory:
+        reset_peak_rss()
+        reset_peak_device_memory(device)
+    start = time.time()
+    yield
+    stats.setdefault('spans', {})[name] = [start, time.time()]
+    if memory:
+        stats.setdefault('peak_rss_mb', {})[name] = peak_rss_mb()
+        device_peak = peak_device_memory_mb(device)
+        if device_peak is not None:
+            stats.setdefault('device_peak_mb', {})[name] = device_peak
+
+
+def merge_stats(into, stats):
+    # stats are dicts of per-stage dicts: seconds, spans, peak_rss_mb and
+    # device_peak_mb. A stage run in both (normalize in Image.load and
+    # crop_heart) adds up its seconds and keeps the higher memory peak.
+    for key, value in stats.items():
+        merged = into.setdefault(key, {})
+        for name, x in value.items():
+            if name not in merged or key == 'spans':
+                merged[name] = x
+            elif key == 'seconds':
+                merged[name] += x
+            else:
+                merged[name] = max(merged[name], x)
+    return into
+
+
+def read_proc_stat(pid):
+    # (parent pid, user + system CPU ticks, resident pages) of a process
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21])
+
+
+def process_tree_usage(root_pid):
+    """CPU ticks and resident bytes of root_pid and all its descendants."""
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                stats[int(entry)] = read_proc_stat(entry)
+            except (OSError, IndexError, ValueError):
+                # the process exited meanwhile
+                pass
+    children = {}
+    for pid, (ppid, _, _) in stats.items():
+        children.setdefault(ppid, []).append(pid)
+    ticks = rss_pages = 0
+    todo = [root_pid]
+    while todo:
+        pid = todo.pop()
+        if pid in stats:
+            ticks += stats[pid][1]
+            rss_pages += stats[pid][2]
+        todo.extend(children.get(pid, []))
+    return ticks, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class DeviceCounters:
+    """Utilization and memory of a CUDA device, read with nvidia-smi.
+
+    Without nvidia-smi only the memory reserved by this process is known.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+        # nvidia-smi numbers the devices ignoring CUDA_VISIBLE_DEVICES
+        self.smi_id = str(device.index)
+        if visible:
+            self.smi_id = visible.split(',')[device.index].strip()
+        self.use_smi = True
+
+    def read(self):
+        if self.use_smi:
+            try:
+                output = subprocess.run(
+                    ['nvidia-smi', '-i', self.smi_id, '--query-gpu=utilization.gpu,memory.used',
+                     '--format=csv,noheader,nounits'],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10, check=True)
+                utilization, memory = output.stdout.decode().strip().split(',')
+                return float(utilization), float(memory)
+            except (OSError, subprocess.SubprocessError, ValueError):
+                self.use_smi = False
+        return None, torch.cuda.memory_reserved(self.device) / 1024 ** 2
+
+
+class ResourceSampler:
+    """Background thread appending CPU, RSS and device usage to a CSV.
+
+    CPU utilization and RSS cover this process and its pipeline workers.
+    cpu_percent is relative to one core, like top, and system_cpu_percent to
+    the whole machine. Device columns stay empty on CPU-only runs.
+    """
+
+    HEADERS = ['timestamp', 'elapsed_seconds', 'cpu_percent', 'system_cpu_percent', 'rss_mb',
+               'gpu_utilization', 'gpu_memory_mb']
+
+    def __init__(self, csv_path, interval=1.0, device=None):
+        self.csv_path = csv_path
+        self.interval = interval
+        self.device_counters = None
+        if device is not None and device.type == 'cuda':
+            self.device_counters = DeviceCounters(device)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='resource-sampler', daemon=True)
+
+    def start(self):
+        with open(self.csv_path, 'w', newline='') as csvfile:
+            csv.writer(csvfile).writerow(self.HEADERS)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    @staticmethod
+    def _system_ticks():
+        with open('/proc/stat') as f:
+            fields = [int(x) for x in f.readline().split()[1:]]
+        # idle and iowait
+        return sum(fields), fields[3] + fields[4]
+
+    def _run(self):
+        tick = os.sysconf('SC_CLK_TCK')
+        pid = os.getpid()
+        start = last_time = time.time()
+        last_ticks, _ = process_tree_usage(pid)
+        last_total, last_idle = self._system_ticks()
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            ticks, rss = process_tree_usage(pid)
+            total, idle = self._system_ticks()
+            # a worker that exited takes its ticks along, hence the max
+            cpu_percent = max(0, ticks - last_ticks) / tick / (now - last_time) * 100
+            system_cpu_percent = 100 * (1 - (idle - last_idle) / max(1, total - last_total))
+            gpu_utilization = gpu_memory = None
+            if self.device_counters is not None:
+                gpu_utilization, gpu_memory = self.device_counters.read()
+            row = [
+                time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(now)) + f'.{int(now % 1 * 1000):03d}',
+                f'{now - start:.3f}', f'{cpu_percent:.1f}', f'{system_cpu_percent:.1f}',
+                f'{rss / 1024 ** 2:.1f}',
+                '' if gpu_utilization is None else gpu_utilization,
+                '' if gpu_memory is None else gpu_memory,
+            ]
+            with open(self.csv_path, 'a', newline='') as csvfile:
+                csv.writer(csvfile).writerow(row)
+            last_time, last_ticks = now, ticks
+            last_total, last_idle = total, idle
@@ -19,8 +19,32 @@ class Anchors(nn.Module):
             self.scales = np.array([2 ** 0, 2 ** (1.0 / 3.0), 2 ** (2.0 / 3.0)])
 
     def forward(self, image):
-        
-        image_shape = image.shape[2:]
+        return self._cached(image)[0]
+
+    def geometry(self, image):
+        """Widths, heights and centers of the anchors, for BBoxTransform."""
+        return self._cached(image)[1]
+
+    def _cached(self, image):
+        # Anchors only depend on the input size, so they are built once per
+        # (H, W, device) and reused for every following slice. The cache is
+        # created lazily because detectors are unpickled without calling
+        # __init__.
+        cache = getattr(self, '_anchor_cache', None)
+        if cache is None:
+            cache = self._anchor_cache = {}
+        key = (int(image.shape[2]), int(image.shape[3]), image.device)
+        if key not in cache:
+            anchors = torch.from_numpy(
+                self.compute_anchors(image.shape[2:]).astype(np.float32)).to(image.device)
+            widths = anchors[:, :, 2] - anchors[:, :, 0]
+            heights = anchors[:, :, 3] - anchors[:, :, 1]
+            ctr_x = anchors[:, :, 0] + 0.5 * widths
+            ctr_y = anchors[:, :, 1] + 0.5 * heights
+            cache[key] = (anchors, (widths, heights, ctr_x, ctr_y))
+        return cache[key]
+
+    def compute_anchors(self, image_shape):
         image_shape = np.array(image_shape)
         image_shapes = [(image_shape + 2 ** x - 1) // (2 ** x) for x in self.pyramid_levels]
 
@@ -32,12 +56,7 @@ class Anchors(nn.Module):
             shifted_anchors = shift(image_shapes[idx], self.strides[idx], anchors)
             all_anchors     = np.append(all_anchors, shifted_anchors, axis=0)
 
-        all_anchors = np.expand_dims(all_anchors, axis=0)
-
-        if torch.cuda.is_available():
-            return torch.from_numpy(all_anchors.astype(np.float32)).cuda()
-        else:
-            return torch.from_numpy(all_anchors.astype(np.float32))
+        return np.expand_dims(all_anchors, axis=0)
 
 def generate_anchors(base_size=16, ratios=None, scales=None):
     """
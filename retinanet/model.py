@@ -2,7 +2,7 @@ import torch.nn as nn
 import torch
 import math
 import torch.utils.model_zoo as model_zoo
-from torchvision.ops import nms
+from torchvision.ops import batched_nms
 from retinanet.utils import BasicBlock, Bottleneck, BBoxTransform, ClipBoxes
 from retinanet.anchors import Anchors
 from retinanet import losses
@@ -235,6 +235,20 @@ class ResNet(nn.Module):
         else:
             img_batch = inputs
 
+        classification, regression, anchors = self.forward_heads(img_batch)
+
+        if self.training:
+            return self.focalLoss(classification, regression, anchors, annotations)
+        else:
+            transformed_anchors = self.regressBoxes(anchors, regression, self.anchors.geometry(img_batch))
+            transformed_anchors = self.clipBoxes(transformed_anchors, img_batch)
+
+            scores, labels, boxes = self.batched_nms(classification, transformed_anchors)
+            num_detections = int((labels[0] >= 0).sum())
+
+            return [scores[0, :num_detections], labels[0, :num_detections], boxes[0, :num_detections]]
+
+    def forward_heads(self, img_batch):
         x = self.conv1(img_batch)
         x = self.bn1(x)
         x = self.relu(x)
@@ -253,49 +267,89 @@ class ResNet(nn.Module):
 
         anchors = self.anchors(img_batch)
 
-        if self.training:
-            return self.focalLoss(classification, regression, anchors, annotations)
-        else:
-            transformed_anchors = self.regressBoxes(anchors, regression)
-            transformed_anchors = self.clipBoxes(transformed_anchors, img_batch)
+        return classification, regression, anchors
+
+    def detect(self, img_batch):
+        """Run the detector on a batch of images in eval mode.
 
-            finalResult = [[], [], []]
+        Returns padded ``scores`` (B x K), ``labels`` (B x K) and ``boxes``
+        (B x K x 4). Detections of each image are sorted by decreasing score;
+        padding entries have score 0, label -1 and an all-zero box.
+        """
+        classification, regression, _ = self.forward_heads(img_batch)
+        return PostProcess(self.anchors, self.regressBoxes, self.clipBoxes)(
+            img_batch, classification, regression)
 
-            finalScores = torch.Tensor([])
-            finalAnchorBoxesIndexes = torch.Tensor([]).long()
-            finalAnchorBoxesCoordinates = torch.Tensor([])
+    def batched_nms(self, classification, transformed_anchors, score_threshold=0.05, iou_threshold=0.5):
+        return batched_detections(classification, transformed_anchors, score_threshold, iou_threshold)
 
-            if torch.cuda.is_available():
-                finalScores = finalScores.cuda()
-                finalAnchorBoxesIndexes = finalAnchorBoxesIndexes.cuda()
-                finalAnchorBoxesCoordinates = finalAnchorBoxesCoordinates.cuda()
 
-            for i in range(classification.shape[2]):
-                scores = torch.squeeze(classification[:, :, i])
-                scores_over_thresh = (scores > 0.05)
-                if scores_over_thresh.sum() == 0:
-                    # no boxes to NMS, just continue
-                    continue
+class DetectorHeads(nn.Module):
+    """Backbone, FPN and heads of a ResNet, returning classification and
+    regression only, as traced by export_models.py."""
 
-                scores = scores[scores_over_thresh]
-                anchorBoxes = torch.squeeze(transformed_anchors)
-                anchorBoxes = anchorBoxes[scores_over_thresh]
-                anchors_nms_idx = nms(anchorBoxes, scores, 0.5)
+    def __init__(self, retinanet):
+        super(DetectorHeads, self).__init__()
+        self.retinanet = retinanet
 
-                finalResult[0].extend(scores[anchors_nms_idx])
-                finalResult[1].extend(torch.tensor([i] * anchors_nms_idx.shape[0]))
-                finalResult[2].extend(anchorBoxes[anchors_nms_idx])
+    def forward(self, img_batch):
+        classification, regression, _ = self.retinanet.forward_heads(img_batch)
+        return classification, regression
 
-                finalScores = torch.cat((finalScores, scores[anchors_nms_idx]))
-                finalAnchorBoxesIndexesValue = torch.tensor([i] * anchors_nms_idx.shape[0])
-                if torch.cuda.is_available():
-                    finalAnchorBoxesIndexesValue = finalAnchorBoxesIndexesValue.cuda()
 
-                finalAnchorBoxesIndexes = torch.cat((finalAnchorBoxesIndexes, finalAnchorBoxesIndexesValue))
-                finalAnchorBoxesCoordinates = torch.cat((finalAnchorBoxesCoordinates, anchorBoxes[anchors_nms_idx]))
+class PostProcess(nn.Module):
+    """Anchor decoding, clipping and NMS of the heads outputs, as in
+    ResNet.detect. Kept out of the exported heads: the anchors depend on the
+    input size and the NMS returns a data dependent number of boxes."""
 
-            return [finalScores, finalAnchorBoxesIndexes, finalAnchorBoxesCoordinates]
+    def __init__(self, anchors=None, regress_boxes=None, clip_boxes=None):
+        super(PostProcess, self).__init__()
+        self.anchors = Anchors() if anchors is None else anchors
+        self.regressBoxes = BBoxTransform() if regress_boxes is None else regress_boxes
+        self.clipBoxes = ClipBoxes() if clip_boxes is None else clip_boxes
 
+    def forward(self, img_batch, classification, regression):
+        anchors = self.anchors(img_batch)
+        transformed_anchors = self.regressBoxes(anchors, regression, self.anchors.geometry(img_batch))
+        transformed_anchors = self.clipBoxes(transformed_anchors, img_batch)
+
+        return batched_detections(classification, transformed_anchors)
+
+
+def batched_detections(classification, transformed_anchors, score_threshold=0.05, iou_threshold=0.5):
+    batch_size, _, num_classes = classification.shape
+
+    # NMS runs independently for every (image, class) pair
+    image_idx, anchor_idx, class_idx = torch.nonzero(
+        classification > score_threshold, as_tuple=True)
+    scores = classification[image_idx, anchor_idx, class_idx]
+    boxes = transformed_anchors[image_idx, anchor_idx]
+    keep = batched_nms(boxes, scores, image_idx * num_classes + class_idx, iou_threshold)
+    image_idx = image_idx[keep]
+    class_idx = class_idx[keep]
+    scores = scores[keep]
+    boxes = boxes[keep]
+
+    # group by image, highest score first (scores are in (0, 1])
+    order = torch.argsort(image_idx.double() * 2 - scores.double())
+    image_idx = image_idx[order]
+    class_idx = class_idx[order]
+    scores = scores[order]
+    boxes = boxes[order]
+
+    counts = torch.bincount(image_idx, minlength=batch_size)
+    max_detections = max(int(counts.max()) if counts.numel() > 0 else 0, 1)
+    offsets = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(image_idx.shape[0], device=image_idx.device) - offsets[image_idx]
+
+    padded_scores = scores.new_zeros((batch_size, max_detections))
+    padded_labels = class_idx.new_full((batch_size, max_detections), -1)
+    padded_boxes = boxes.new_zeros((batch_size, max_detections, 4))
+    padded_scores[image_idx, rank] = scores
+    padded_labels[image_idx, rank] = class_idx
+    padded_boxes[image_idx, rank] = boxes
+
+    return padded_scores, padded_labels, padded_boxes
 
 
 def resnet18(num_classes, pretrained=False, **kwargs):
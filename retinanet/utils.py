@@ -99,12 +99,24 @@ class BBoxTransform(nn.Module):
         else:
             self.std = std
 
-    def forward(self, boxes, deltas):
-
-        widths  = boxes[:, :, 2] - boxes[:, :, 0]
-        heights = boxes[:, :, 3] - boxes[:, :, 1]
-        ctr_x   = boxes[:, :, 0] + 0.5 * widths
-        ctr_y   = boxes[:, :, 1] + 0.5 * heights
+    def _apply(self, fn):
+        # mean and std are plain tensors rather than buffers (the detector
+        # checkpoint is a pickled module), so move them along explicitly
+        super(BBoxTransform, self)._apply(fn)
+        self.mean = fn(self.mean)
+        self.std = fn(self.std)
+        return self
+
+    def forward(self, boxes, deltas, geometry=None):
+
+        if geometry is None:
+            widths  = boxes[:, :, 2] - boxes[:, :, 0]
+            heights = boxes[:, :, 3] - boxes[:, :, 1]
+            ctr_x   = boxes[:, :, 0] + 0.5 * widths
+            ctr_y   = boxes[:, :, 1] + 0.5 * heights
+        else:
+            # precomputed by Anchors.geometry
+            widths, heights, ctr_x, ctr_y = geometry
 
         dx = deltas[:, :, 0] * self.std[0] + self.mean[0]
         dy = deltas[:, :, 1] * self.std[1] + self.mean[1]
@@ -135,10 +147,9 @@ class ClipBoxes(nn.Module):
 
         batch_size, num_channels, height, width = img.shape
 
-        boxes[:, :, 0] = torch.clamp(boxes[:, :, 0], min=0)
-        boxes[:, :, 1] = torch.clamp(boxes[:, :, 1], min=0)
+        boxes[:, :, :2].clamp_(min=0)
 
-        boxes[:, :, 2] = torch.clamp(boxes[:, :, 2], max=width)
-        boxes[:, :, 3] = torch.clamp(boxes[:, :, 3], max=height)
+        boxes[:, :, 2].clamp_(max=width)
+        boxes[:, :, 3].clamp_(max=height)
       
         return boxes
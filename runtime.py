@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Device selection and inference settings shared by the detector and Tri2DNet
+
+import contextlib
+import os
+
+import numpy as np
+import torch
+
+
+def resolve_device(device=None):
+    # None keeps the historical behaviour: CUDA when it is available
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    if device.type == 'cuda':
+        if not torch.cuda.is_available():
+            raise RuntimeError(
+                'Device {} requested but CUDA is not available. '
+                'Use --device cpu on nodes without a GPU.'.format(device))
+        if device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+    return device
+
+
+def configure_cpu(num_threads=None):
+    # Intra-op threads for CPU inference, by default one per usable core
+    if num_threads is None:
+        if hasattr(os, 'sched_getaffinity'):
+            num_threads = len(os.sched_getaffinity(0))
+        else:
+            num_threads = os.cpu_count()
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def inference_mode():
+    # torch.inference_mode only exists from PyTorch 1.9 on
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+
+def autocast(device, precision='fp32'):
+    # Mixed precision context of Tri2DNet inference: bf16 runs on CPU and
+    # recent GPUs, fp16 on GPU only. fp32 disables it.
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}'.format(precision))
+    if precision == 'fp16' and device.type != 'cuda':
+        raise RuntimeError('Precision fp16 needs a GPU, use bf16 on CPU.')
+    dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+    # torch.autocast only exists from PyTorch 1.10 on
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device.type, dtype=dtype)
+    if device.type == 'cuda' and precision == 'fp16':
+        return torch.cuda.amp.autocast()
+    raise RuntimeError(
+        'Precision {} on {} needs PyTorch 1.10 or later.'.format(precision, device.type))
+
+
+def use_channels_last(device):
+    # NHWC convolutions are markedly faster with the oneDNN CPU kernels
+    return device.type == 'cpu'
+
+
+def available_memory(device):
+    # Bytes that can still be allocated on the device
+    if device.type == 'cuda':
+        if hasattr(torch.cuda, 'mem_get_info'):
+            return torch.cuda.mem_get_info(device)[0]
+        return (torch.cuda.get_device_properties(device).total_memory
+                - torch.cuda.memory_reserved(device))
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def default_batch_size(device, item_mb, max_batch_size, cpu_batch_size):
+    # Number of items of ~item_mb each that fit in half of the free memory,
+    # at most cpu_batch_size on CPU where larger batches do not run faster
+    batch_size = int(available_memory(device) * 0.5 / (item_mb * 1024 ** 2))
+    if device.type != 'cuda':
+        max_batch_size = min(max_batch_size, cpu_batch_size)
+    return int(np.clip(batch_size, 1, max_batch_size))
+
+
+def load_scripted(path, device):
+    # Frozen TorchScript module written by export_models.py for this device
+    # type. optimize_for_inference (PyTorch 1.9 on) fuses it further for the
+    # device; its graph cannot be saved, so it runs at every load, and not
+    # every graph gets through it.
+    if not os.path.isfile(path):
+        raise FileNotFoundError(
+            '{} not found, export the models for {} with export_models.py first.'.format(path, device.type))
+    module = torch.jit.load(path, map_location=device)
+    module.eval()
+    if hasattr(torch.jit, 'optimize_for_inference'):
+        try:
+            return torch.jit.optimize_for_inference(module)
+        except RuntimeError:
+            # the pass may have left the module half rewritten
+            module = torch.jit.load(path, map_location=device)
+            module.eval()
+    return module
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# crop_resample (--crop-first) against the full-grid SimpleITK resampling
+#   python -m pytest tests/
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bbox_cut import calibrate_resizer  # noqa: E402
+
+NEW_SIZE = np.asarray([48, 48, 48])
+
+
+def synthetic_ct(dtype):
+    # (z, y, x) = 16 x 20 x 22 voxels of 0.7 x 0.7 x 2.5 mm, in HU
+    array = np.random.default_rng(0).uniform(-1000, 1000, (16, 20, 22)).astype(dtype)
+    image = sitk.GetImageFromArray(array)
+    image.SetSpacing((0.7, 0.7, 2.5))
+    return image
+
+
+def resample_both(image, min_point, max_point, default_value):
+    full_grid, crop_first = [
+        sitk.GetArrayFromImage(calibrate_resizer(
+            image, np.asarray(min_point), np.asarray(max_point), NEW_SIZE,
+            default_value=default_value, crop_first=crop_first)).astype('float64')
+        for crop_first in (False, True)]
+    return full_grid, crop_first
+
+
+@pytest.mark.parametrize('dtype, tolerance', [('int16', 1), ('float32', 1e-3)])
+@pytest.mark.parametrize('min_point, max_point', [
+    ((4, 5, 2), (20, 16, 12)),  # inside the volume
+    ((0, 0, 0), (22, 20, 16)),  # the whole volume, touching every edge
+    ((12, 0, 8), (22, 8, 16)),  # touching the far x and z edges
+])
+@pytest.mark.parametrize('default_value', [-1500, None])
+def test_crop_first_matches_full_grid(dtype, tolerance, min_point, max_point, default_value):
+    # up to 1 HU of rounding of the integer volumes
+    full_grid, crop_first = resample_both(synthetic_ct(dtype), min_point, max_point, default_value)
+    assert np.abs(full_grid - crop_first).max() <= tolerance
+
+
+def test_crop_first_fills_beyond_the_edge():
+    # upsampled bbox ending at the image border: the last output points map
+    # beyond the outer voxel edges, where SimpleITK writes default_value
+    full_grid, crop_first = resample_both(synthetic_ct('int16'), (0, 0, 0), (22, 20, 16), -1500)
+    outside = full_grid == -1500
+    assert outside[-1].all() and outside[:, -1].all() and outside[:, :, -1].all()
+    assert np.array_equal(crop_first == -1500, outside)
@@ -3,10 +3,25 @@
 # @Time    : 2020/10/28
 
 
+import numpy as np
 import SimpleITK as sitk
 
+# Interpolator of the resamples for each --preprocess-profile
+INTERPOLATORS = {
+    'accurate': sitk.sitkGaussian,
+    'fast': sitk.sitkLinear,
+}
 
-def CT_resize(image, new_size=None, new_space=None, new_direction=None, new_org=None):
+
+def image_min(image):
+    # Multi-threaded minimum, without copying the volume into numpy
+    min_max = sitk.MinimumMaximumImageFilter()
+    min_max.Execute(image)
+    return min_max.GetMinimum()
+
+
+def CT_resize(image, new_size=None, new_space=None, new_direction=None, new_org=None,
+              default_value=None, interpolator=sitk.sitkGaussian):
     if new_size is None:
         new_size = image.GetSize()
     if new_space is None:
@@ -20,18 +35,86 @@ def CT_resize(image, new_size=None, new_space=None, new_direction=None, new_org=
     resampler.SetOutputSpacing(new_space)
     resampler.SetSize(new_size)
     resampler.SetOutputOrigin(new_org)
-    resampler.SetInterpolator(sitk.sitkGaussian)
-    resampler.SetDefaultPixelValue(
-        sitk.GetArrayFromImage(image).min().astype('float'))
+    resampler.SetInterpolator(interpolator)
+    # points outside the input are filled with its minimum (air)
+    if default_value is None:
+        default_value = image_min(image)
+    resampler.SetDefaultPixelValue(float(default_value))
     return resampler.Execute(image)
 
 
-def norm(input_array, norm_down, norm_up):
-    input_array = input_array.astype('float32')
-    normed_array = (input_array - norm_down) / (norm_up - norm_down)
-    normed_array[normed_array > 1] = 1
-    normed_array[normed_array < 0] = 0
-    return normed_array
+def norm(input_array, norm_down, norm_up, out=None, dtype='float32', chunk=32):
+    """Window input_array to [norm_down, norm_up] and scale it to [0, 1].
+
+    The result is written to out (allocated with dtype if not given). A
+    float32 out is computed in place; float16 and uint8 (0-255) outputs go
+    through a float32 buffer of chunk slices.
+    """
+    if out is None:
+        out = np.empty(input_array.shape, dtype=dtype)
+    if out.dtype == np.float32:
+        _norm(input_array, norm_down, norm_up, out)
+        return out
+    buffer = np.empty((chunk,) + input_array.shape[1:], dtype='float32')
+    for start in range(0, input_array.shape[0], chunk):
+        normed = _norm(input_array[start:start + chunk], norm_down, norm_up,
+                       buffer[:len(input_array[start:start + chunk])])
+        if out.dtype == np.uint8:
+            normed *= 255
+            np.rint(normed, out=normed)
+        out[start:start + chunk] = normed
+    return out
+
+
+def _norm(input_array, norm_down, norm_up, out):
+    np.subtract(input_array, norm_down, out=out, dtype='float32')
+    np.divide(out, norm_up - norm_down, out=out)
+    return np.clip(out, 0, 1, out=out)
+
+
+def to_network_input(data, out=None, device=None):
+    """Stack a normalized heart volume with its masked copy into a 2xDxHxW array.
+
+    The calcium/soft-tissue mask is built and smoothed in float32 inside
+    out[1], which may be a preallocated buffer. With a torch device the
+    Gaussian runs there as three 1D convolutions.
+    """
+    if out is None:
+        out = np.empty((2,) + data.shape, dtype='float32')
+    out[0] = data
+    mask = out[1]
+    # the two windows do not overlap, so the clipped sum is a logical or
+    mask[...] = ((data > 0.1375) & (data < 0.3375)) | (data > 0.5375)
+    if device is None:
+        # scipy is only loaded on the CPU path
+        from scipy.ndimage import gaussian_filter
+        gaussian_filter(mask, sigma=3, output=mask)
+    else:
+        import torch
+        mask[...] = gaussian_filter_torch(
+            torch.from_numpy(mask).to(device), sigma=3).cpu().numpy()
+    np.multiply(mask, out[0], out=mask)
+    return out
+
+
+def gaussian_filter_torch(volume, sigma, truncate=4.0):
+    # Separable Gaussian matching scipy.ndimage.gaussian_filter(mode='reflect')
+    import torch
+    import torch.nn.functional as F
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * x ** 2 / sigma ** 2)
+    kernel = torch.as_tensor(kernel / kernel.sum(), dtype=volume.dtype, device=volume.device)
+    kernel = kernel.view(1, 1, -1)
+    for axis in range(volume.dim()):
+        lines = volume.transpose(axis, -1)
+        shape = lines.shape
+        lines = lines.reshape(-1, 1, shape[-1])
+        # scipy's reflect mode repeats the edge sample: d c b a | a b c d
+        lines = torch.cat([
+            lines[..., :radius].flip(-1), lines, lines[..., -radius:].flip(-1)], dim=-1)
+        volume = F.conv1d(lines, kernel).reshape(shape).transpose(axis, -1)
+    return volume.contiguous()
 
 
 def visualize_data(npy_img):
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+# Score a test set in fp32 and in a mixed precision and report how far the
+# risk scores move, before turning --precision on in production. Arguments
+# that are not listed below are passed on to cvdrisk_BIDS.py, e.g.
+#   python validate_precision.py --input-list test_paths.txt --precision bf16 --device cpu
+
+from validate_profiles import build_parser, validate
+
+
+def main():
+    parser = build_parser('Inference precision validation', './derived/precision_validation/')
+    parser.add_argument('--precision', default='bf16', type=str, choices=['bf16', 'fp16'],
+                        help='precision: mixed precision compared to fp32, bf16 (CPU, recent GPUs) or fp16 (GPU). Default: bf16')
+    opt, run_args = parser.parse_known_args()
+    validate(opt, run_args, '--precision', 'fp32', opt.precision, 'precision_agreement')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Score a test set with each preprocessing profile and report how far the
+# risk scores of the fast profile move from the accurate one. Arguments that
+# are not listed below are passed on to cvdrisk_BIDS.py, e.g.
+#   python validate_profiles.py --input-list test_paths.txt --output-dir validation/ --device cuda:0
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from agreement import compare_results, write_report
+
+PROFILES = ['accurate', 'fast']
+
+
+def build_parser(description, default_output_dir):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--input-list', default='file_paths.txt', type=str,
+                        help='input-list: path to the text file containing the test set paths. Default: ./file_paths.txt')
+    parser.add_argument('--output-dir', default=default_output_dir, type=str,
+                        help=f'output-dir: directory for one run per setting and the report. Default: {default_output_dir}')
+    parser.add_argument('--compare-only', action='store_true',
+                        help='compare-only: only compare the runs already in output-dir')
+    return parser
+
+
+def validate(opt, run_args, option, reference, candidate, report_name):
+    """Score the input list with --option reference and candidate, in
+    output_dir/<value>, and write the agreement of candidate to reference."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cvdrisk_BIDS.py')
+    csv_paths = {}
+    for value in (reference, candidate):
+        output_dir = os.path.join(opt.output_dir, value)
+        csv_paths[value] = os.path.join(output_dir, 'cvd_results.csv')
+        if opt.compare_only:
+            continue
+        print(f'Scoring {opt.input_list} with {option} {value}...')
+        subprocess.run(
+            [sys.executable, script, '--input-list', opt.input_list, '--output-dir', output_dir,
+             option, value] + run_args,
+            check=True)
+
+    summary, rows = compare_results(csv_paths[reference], csv_paths[candidate])
+    report_path = os.path.join(opt.output_dir, f'{report_name}.csv')
+    write_report(rows, report_path)
+    with open(os.path.join(opt.output_dir, f'{report_name}.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(json.dumps(summary, indent=2))
+    print(f'Per-scan comparison saved to {report_path}')
+    return summary
+
+
+def main():
+    opt, run_args = build_parser('Preprocessing profile validation', './derived/validation/').parse_known_args()
+    validate(opt, run_args, '--preprocess-profile', PROFILES[0], PROFILES[1], 'profile_agreement')
+
+
+if __name__ == '__main__':
+    main()
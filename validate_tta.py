@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+# Score a test set with the exact and the shared test-time augmentation of
+# Tri2DNet and report how far the risk scores move, before turning --tta
+# shared on in production. Arguments that are not listed below are passed on
+# to cvdrisk_BIDS.py, e.g.
+#   python validate_tta.py --input-list test_paths.txt --device cuda:0
+
+from validate_profiles import build_parser, validate
+
+
+def main():
+    opt, run_args = build_parser('Test-time augmentation validation', './derived/tta_validation/').parse_known_args()
+    validate(opt, run_args, '--tta', 'exact', 'shared', 'tta_agreement')
+
+
+if __name__ == '__main__':
+    main()
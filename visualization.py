@@ -37,12 +37,14 @@ class GradCam(nn.Module):
         self.f_output = None
 
     def regist(self):
-        self.model.module.branch_axial.backbone2d.register_backward_hook(self.save_axial_grad)
-        self.model.module.branch_axial.backbone2d.register_forward_hook(self.save_axial_output)
-        self.model.module.branch_coronal.backbone2d.register_backward_hook(self.save_coronal_grad)
-        self.model.module.branch_coronal.backbone2d.register_forward_hook(self.save_coronal_output)
-        self.model.module.branch_sagittal.backbone2d.register_backward_hook(self.save_sagittal_grad)
-        self.model.module.branch_sagittal.backbone2d.register_forward_hook(self.save_sagittal_output)
+        # the encoder is wrapped in nn.DataParallel only on CUDA
+        net = getattr(self.model, 'module', self.model)
+        net.branch_axial.backbone2d.register_backward_hook(self.save_axial_grad)
+        net.branch_axial.backbone2d.register_forward_hook(self.save_axial_output)
+        net.branch_coronal.backbone2d.register_backward_hook(self.save_coronal_grad)
+        net.branch_coronal.backbone2d.register_forward_hook(self.save_coronal_output)
+        net.branch_sagittal.backbone2d.register_backward_hook(self.save_sagittal_grad)
+        net.branch_sagittal.backbone2d.register_forward_hook(self.save_sagittal_output)
 
     def save_axial_grad(self, model, grad_input, grad_output):
         self.axial_grad = grad_output